@@ -0,0 +1,187 @@
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+SIZES = [1000, 100000, 1000000]
+REPEAT = 3
+SEED = 0
+FIRST_NAMES = ["Alex", "Olena", "Ivan", "Maria", "Taras", "Iryna", "Petro", "Oksana", "Andrii", "Sofia"]
+LAST_NAMES = ["Shevchenko", "Kovalenko", "Bondarenko", "Tkachenko", "Kravchenko", "Melnyk", "Boyko", "Lysenko"]
+OPERATORS = ["50", "63", "66", "67", "68", "73", "93", "95", "96", "97", "98", "99"]
+DOMAINS = ["gmail.com", "ukr.net", "i.ua", "example.com"]
+QUERIES = ["ale", "Kovalenko", "olena bo", "38067", "0501", "zzz"]
+# a regex is not served by the trigram index, so it scans names in order
+SCAN_QUERY = "re:ol.na"
+# misspelled on purpose, ranked by trigram similarity
+FUZZY_QUERY = "~olena kovalneko 12"
+
+
+def make_book(n: int, rnd: random.Random) -> dict:
+    book = {}
+    for i in range(n):
+        name = f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)} {i}"
+        x = rnd.random()
+        if x < 0.35:
+            birthday = f"{rnd.randint(1, 12):02}-{rnd.randint(1, 28):02}"
+        elif x < 0.7:
+            birthday = f"{rnd.randint(1950, 2010)}-{rnd.randint(1, 12):02}-{rnd.randint(1, 28):02}"
+        else:
+            birthday = None
+        email = f"{name.lower().replace(' ', '.')}@{rnd.choice(DOMAINS)}" if rnd.random() < 0.6 else None
+        phone = [
+            "380" + rnd.choice(OPERATORS) + f"{rnd.randrange(10 ** 7):07}"
+            for _ in range(rnd.choice((0, 1, 1, 1, 2, 2, 3)))
+        ]
+        book[name] = {"name": name, "birthday": birthday, "email": email, "phone": list(dict.fromkeys(phone))}
+    return book
+
+
+def make_commands(book: dict, birthdays: bool) -> list:
+    # A scripted session: add every contact, look it up, change and delete a phone
+    commands = ["hello", "help"]
+    for v in book.values():
+        user = v["name"].replace(" ", "_")
+        args = v["phone"] or ["380500000000"]
+        # bot3 takes mm-dd only, and rejects 01-01 (stored as 1900-01-01)
+        if birthdays and v["birthday"] and len(v["birthday"]) == 5 and v["birthday"] != "01-01":
+            args = [v["birthday"]] + args
+        commands.append(" ".join(["add", user] + args))
+        commands.append(f"phone {user}")
+    for v in list(book.values())[::10]:
+        user = v["name"].replace(" ", "_")
+        commands.append(f"change {user} 380991234567")
+        commands.append(f"delete {user} 380991234567")
+    return commands
+
+
+def timeit(f, repeat=REPEAT, setup=None) -> float:
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        t = perf_counter()
+        f(arg) if setup else f()
+        t = perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def import_bots():
+    import bot2, bot3, bot4
+
+    return bot2, bot3, bot4
+
+
+def bench_bot4(bot4, path: Path, n: int, repeat: int) -> list:
+    r = []
+
+    def add(name, seconds, **extra):
+        r.append({"bench": name, "size": n, "seconds": seconds, **extra})
+        print(f"{name:<24} {n:>9} {seconds:10.4f}s", file=sys.stderr)
+
+    add("read_from_file", timeit(lambda: bot4.AddressBook(path), repeat))
+    add("read_from_file_eager", timeit(lambda: bot4.AddressBook(path, lazy=False), repeat))
+    book = bot4.AddressBook(path)
+    add("select_first_page", timeit(lambda: next(book.select(bot4.PAGE_SIZE)), repeat))
+    add("select_all", timeit(lambda: list(book.select(bot4.PAGE_SIZE)), repeat))
+    add("select_search_cold", timeit(lambda: list(book.select(bot4.PAGE_SIZE, QUERIES[0])), 1))
+
+    def uncached():
+        # a complete search is cached; time the search itself, not the hit
+        book.query_cache.clear()
+
+    for q in QUERIES:
+        add("select_search", timeit(lambda _: list(book.select(bot4.PAGE_SIZE, q)), repeat, uncached), query=q)
+        add("select_search_cached", timeit(lambda: list(book.select(bot4.PAGE_SIZE, q)), repeat), query=q)
+    add(
+        "select_scan_first_page",
+        timeit(lambda: next(book.select(bot4.PAGE_SIZE, SCAN_QUERY), None), repeat),
+        query=SCAN_QUERY,
+    )
+    add(
+        "select_scan",
+        timeit(lambda _: list(book.select(bot4.PAGE_SIZE, SCAN_QUERY)), repeat, uncached),
+        query=SCAN_QUERY,
+    )
+    add(
+        "select_fuzzy",
+        timeit(lambda: next(book.select(bot4.PAGE_SIZE, FUZZY_QUERY), None), repeat),
+        query=FUZZY_QUERY,
+    )
+    add("count_phones_cold", timeit(lambda: book.count_phones("38050"), 1), prefix="38050")
+    add("count_phones", timeit(lambda: book.count_phones("38050"), repeat), prefix="38050")
+    add("find_phone", timeit(lambda: book.find_phone("3805012"), repeat), prefix="3805012")
+    page = next(book.select(bot4.PAGE_SIZE), [])
+    add("render_page", timeit(lambda: book.render(page), repeat))
+    add("to_dict", timeit(book.to_dict, repeat))
+    add("write_to_file", timeit(lambda: book.write_to_file(force=True), repeat))
+    name = next(iter(book.keys()))
+    phones = iter(f"3809{i:08}" for i in range(repeat))
+    add("journal_append", timeit(lambda: book.add_phone(name, bot4.Phone(next(phones))), repeat))
+    book.journal_path.unlink(missing_ok=True)
+    return r
+
+
+def bench_parse_command(bot, label: str, commands: list, n: int, repeat: int) -> dict:
+    def run(_):
+        for c in commands:
+            bot.parse_command(c)
+            if hasattr(bot, "log"):
+                bot.log.clear()
+
+    seconds = timeit(run, repeat, setup=bot.d.clear)
+    print(f"{label:<24} {n:>9} {seconds:10.4f}s", file=sys.stderr)
+    return {
+        "bench": label,
+        "size": n,
+        "seconds": seconds,
+        "commands": len(commands),
+        "commands_per_second": len(commands) / seconds if seconds else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Address book benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", type=Path, help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        bot2, bot3, bot4 = import_bots()
+        for n in args.sizes:
+            book = make_book(n, random.Random(args.seed))
+            path = workdir / f"ab_{n}.json"
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(book, f)
+            results.extend(bench_bot4(bot4, path, n, args.repeat))
+            results.append(
+                bench_parse_command(bot2, "bot2_parse_command", make_commands(book, False), n, args.repeat)
+            )
+            results.append(
+                bench_parse_command(bot3, "bot3_parse_command", make_commands(book, True), n, args.repeat)
+            )
+            del book
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
+from latency import stats
+
 d = {}
+stats.count_records = lambda: len(d)
 
 
 def input_error(f):
@@ -40,6 +43,7 @@ def phone_h(user: str) -> str:
     return d[user]
 
 
+@stats.command
 @input_error
 def parse_command(s: str) -> str:
     if s[:3].lower() == "add":
@@ -47,7 +51,7 @@ def parse_command(s: str) -> str:
     elif s[:4].lower() == "exit":
         return "Good bye!"
     elif s[:4].lower() == "help":
-        return "Valid commands are:\n---\nadd <user> <phone>\nchange <user> <phone>\nphone <user>\nshow all\nclose\nexit\ngood bye\nhello\n---"
+        return "Valid commands are:\n---\nadd <user> <phone>\nchange <user> <phone>\nphone <user>\nshow all\nstats\nclose\nexit\ngood bye\nhello\n---"
     elif s[:5].lower() == "hello":
         return "How can I help you?"
     elif s[:5].lower() == "close":
@@ -62,6 +66,8 @@ def parse_command(s: str) -> str:
             + "-" * 20 + " " + "-" * 12 + "\n"
             + "\n".join("{:<20} {:<12}".format(k, v) for k, v in d.items())
         )
+    elif s[:5].lower() == "stats":
+        return str(stats)
     elif s[:8].lower() == "good bye":
         return "Good bye!"
     else:
@@ -1,4 +1,5 @@
 from collections import UserDict
+from latency import stats
 
 
 class Field:
@@ -84,6 +85,7 @@ class AddressBook(UserDict):
 
 
 d = AddressBook()
+stats.count_records = lambda: len(d)
 
 
 def input_error(f):
@@ -125,6 +127,10 @@ def show_all(*_) -> str:
     return str(d)
 
 
+def stats_h(*_) -> str:
+    return str(stats)
+
+
 def exit_h(*_) -> str:
     return "Good bye!"
 
@@ -138,6 +144,7 @@ def help_h(*_) -> str:
     + "delete <user> <phone|phone list>\n"
     + "phone <user>\n"
     + "show all\n"
+    + "stats\n"
     + "close\n"
     + "exit\n"
     + "good bye\n"
@@ -156,9 +163,11 @@ commands = {
     "change":change_h,
     "delete":delete_h,
     "show all":show_all,
+    "stats":stats_h,
     "good bye":exit_h,
 }
 
+@stats.command
 @input_error
 def parse_command(s: str) -> str:
     r = "Unrecognized command. Try typing 'help'."
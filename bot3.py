@@ -1,9 +1,20 @@
+import sys
+from array import array
+from contextlib import redirect_stdout
 from collections import UserDict
-from datetime import datetime
+from datetime import date, datetime
+from functools import lru_cache
 from re import search
+from latency import stats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 RECORD_HEADER = "{:^20} {:^27} {:^20}".format("User", "Birthday", "Phone number(s)") + "\n" + "-" * 20 + " " + "-" * 27 + " " + "-" * 20 + "\n"
 N = 10
+BATCH_BUFFER = 1 << 16
 
 class Field:
     def __init__(self, value=None):
@@ -50,6 +61,41 @@ def str_days_left(days: int) -> str:
     return "" if days is None else f" ({days} days left)"
 
 
+@lru_cache(maxsize=4)
+def occurrences(year: int) -> tuple:
+    # ordinal of each month * 32 + day in the given year, Feb-29 -> Feb-28 in common years;
+    # cached, as every page render asks for the same two years
+    table = [0] * 13 * 32
+    for m in range(1, 13):
+        for day in range(1, 32):
+            try:
+                table[m * 32 + day] = date(year, m, day).toordinal()
+            except ValueError:
+                if m == 2 and day == 29:
+                    table[m * 32 + day] = date(year, 2, 28).toordinal()
+    return tuple(table)
+
+
+def days_to_birthdays(months: array, days: array, now=None) -> list:
+    # Batch Record.days_to_birthday over packed month/day arrays
+    now = now or datetime.now()
+    today = now.toordinal()
+    shift = 0 if now == datetime.combine(now.date(), datetime.min.time()) else 1
+    this_year, next_year = occurrences(now.year), occurrences(now.year + 1)
+    if np is not None:
+        idx = np.frombuffer(months, np.uint8).astype(np.intp) * 32 + np.frombuffer(days, np.uint8)
+        occ = np.asarray(this_year)[idx]
+        occ = np.where(occ < today, np.asarray(next_year)[idx], occ)
+        return (occ - today - shift).tolist()
+    r = []
+    for m, day in zip(months, days):
+        occ = this_year[m * 32 + day]
+        if occ < today:
+            occ = next_year[m * 32 + day]
+        r.append(occ - today - shift)
+    return r
+
+
 class Record:
     def __init__(self, name: Name, birthday=None, phone=None):
         self.name = name
@@ -97,8 +143,11 @@ class Record:
                 y += 1
             return (datetime(year=y, month=m, day=d) - n).days
 
+    def to_str(self, days_left=None) -> str:
+        return "{:<20} {:<27} {:<20}".format(self.name, str(self.birthday) + str_days_left(days_left), ", ".join(str(p) for p in self.phone))
+
     def __str__(self) -> str:
-        return "{:<20} {:<27} {:<20}".format(self.name, str(self.birthday) + str_days_left(self.days_to_birthday()), ", ".join(str(p) for p in self.phone))
+        return self.to_str(self.days_to_birthday())
 
 
 class IterPage:
@@ -127,15 +176,35 @@ class AddressBook(UserDict):
         self.data[name] = Record(name, birthday, phone)
         return len(self.data[name].phone)
 
+    def days_to_birthdays(self, names) -> list:
+        records = [self.data[n] for n in names]
+        months, days, pos = array("B"), array("B"), []
+        for i, r in enumerate(records):
+            if r.birthday:
+                months.append(r.birthday.value.month)
+                days.append(r.birthday.value.day)
+                pos.append(i)
+        left = [None] * len(records)
+        for i, x in zip(pos, days_to_birthdays(months, days)):
+            left[i] = x
+        return left
+
+    def render(self, names) -> list:
+        names = list(names)
+        return [self.data[n].to_str(x) for n, x in zip(names, self.days_to_birthdays(names))]
+
     def __str__(self) -> str:
-        return RECORD_HEADER + "\n".join(str(v) for v in self.values())
+        return RECORD_HEADER + "\n".join(self.render(self.data))
 
     def iterator(self, page_length):
         return IterPage(self, page_length)
 
 
 d = AddressBook()
+stats.count_records = lambda: len(d)
 log = []
+# False in batch mode: show all prints every page without waiting for Enter
+paginate = True
 
 
 def input_error(f):
@@ -242,14 +311,19 @@ def show_all(*_) -> str:
         return "Contact list is empty"
     for x in d.iterator(N):
         if x:
-            print(RECORD_HEADER + "\n".join(str(d[r]) for r in x))
-            if len(x) == N:
-                s = input("Press Enter to see the next page ('stop' to finish)")
+            print(RECORD_HEADER + "\n".join(d.render(x)))
+            if paginate and len(x) == N:
+                with stats.waiting():
+                    s = input("Press Enter to see the next page ('stop' to finish)")
                 if s.lower() == "stop":
                     break
     return ""
 
 
+def stats_h(*_) -> str:
+    return str(stats)
+
+
 def exit_h(*_) -> str:
     return "Good bye!"
 
@@ -263,6 +337,7 @@ def help_h(*_) -> str:
     + "delete <user> [birthday] <phone|phone list>\n"
     + "phone <user>\n"
     + "show all\n"
+    + "stats\n"
     + "close\n"
     + "exit\n"
     + "good bye\n"
@@ -285,10 +360,12 @@ commands = {
     "change":change_h,
     "delete":delete_h,
     "show all":show_all,
+    "stats":stats_h,
     "good bye":exit_h,
 }
 
 
+@stats.command
 @input_error
 def parse_command(s: str):
     r = "Unrecognized command. Try typing 'help'."
@@ -305,7 +382,31 @@ def parse_command(s: str):
     return r
 
 
-if __name__ == "__main__":
+def run_batch(lines):
+    # Run one command per line without prompts or paging, printing each
+    # command's log as soon as it is done
+    global log, paginate
+    paginate = False
+    for s in lines:
+        log = []
+        x = parse_command(s.strip())
+        print("\n".join(log))
+        if x == "Good bye!":
+            break
+
+
+def batch_main(path: str):
+    # bot3.py <script> or bot3.py - (stdin): all output goes through one
+    # buffered writer instead of a flush per prompt
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    out = open(sys.stdout.fileno(), "w", encoding="utf-8", buffering=BATCH_BUFFER, closefd=False)
+    with f, out, redirect_stdout(out):
+        run_batch(f)
+
+
+if __name__ == "__main__" and (len(sys.argv) > 1 or not sys.stdin.isatty()):
+    batch_main(sys.argv[1] if len(sys.argv) > 1 else "-")
+elif __name__ == "__main__":
     print(help_h())
     while True:
         log = []
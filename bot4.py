@@ -1,9 +1,38 @@
+import io
+import os
 import sys
+import csv
+import gzip
 import json
+import lzma
+import zlib
+import sqlite3
+import atexit
+import shutil
+import multiprocessing
+import queue
+import signal
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left, bisect_right, insort
+from heapq import heapify, heappop, heappush, nsmallest, merge as merge_sorted
+from itertools import chain, groupby, islice
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
+from time import perf_counter
 from pathlib import Path
-from collections import UserDict
-from datetime import datetime
+from collections import Counter, OrderedDict, UserDict, defaultdict, deque
+from calendar import isleap
+from datetime import date, datetime, timedelta
+import re
 from re import search
+from latency import stats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DEFAULT_FILENAME = "ab.json"
 RECORD_HEADER = (
@@ -27,9 +56,14 @@ MESSAGE = {
     A_MAIN: (
         "1 = Add new contact\n"
         + "2 = Show all (easy way to select one)\n"
+        + "3 = Upcoming birthdays\n"
+        + "4 = Import contacts (CSV or vCard file)\n"
+        + "5 = Export contacts (CSV, vCard, NDJSON or JSON file)\n"
+        + "stats = Command latency statistics\n"
         + "0 = Exit (Ctrl+C)\n"
         + LINE
-        + "\nSelect an option or type some symbols to search by name/phone: "
+        + "\nSelect an option or type some symbols to search by name/phone"
+        + "\n(prefix with 're:' for a regular expression, '~' for names spelled alike): "
     ),
     A_ADD: (
         LINE
@@ -65,16 +99,504 @@ MESSAGE = {
 }
 PAGE_SIZE = 5
 PAGE_MESSAGE = "Press Enter to see next page or type a row number to select corresponding contact (Ctrl+C to exit): "
+BIRTHDAY_DAYS = 7
+BIRTHDAY_MESSAGE = f"Show birthdays for how many days ahead (default {BIRTHDAY_DAYS}): "
+EXPORT_MESSAGE = "Enter the path of the file to export to (.csv, .vcf, .ndjson or .json): "
+IMPORT_MESSAGE = "Enter the path of a CSV (name, birthday, email, phone columns) or vCard file: "
 CTRL_C = "{~"
 F6 = "}~"
 MIN_YEAR = 1896
 NUMBER_FORMAT = 1
+GRAM_SIZE = 3
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_LIMIT = 1000
+CHUNK_SIZE = 1 << 16
+WRITE_BUFFER = 1 << 20
+# Compressed snapshots (ab.json.gz, ab.json.xz) use a columnar layout: a
+# header line, then one JSON line per block of contacts with a list per field
+SNAPSHOT_FORMAT = "columns"
+SNAPSHOT_BLOCK = 4096
+# gzip's default level 9 is several times slower to write for ~5% less
+gzip_open = partial(gzip.open, compresslevel=6)
+SNAPSHOT_SUFFIXES = {".gz": gzip_open, ".xz": lzma.open}
+SNAPSHOT_MAGIC = {b"\x1f\x8b": gzip_open, b"\xfd7zXZ\x00": lzma.open}
+CONTACT_FIELDS = ("name", "birthday", "email", "phone")
+AUTOSAVE_DELAY = 2.0
+ORDER_CHUNK = 1024
+# complete search results kept by AddressBook.select, least recently used out
+QUERY_CACHE_SIZE = 64
+# contacts per import_contacts worker task
+IMPORT_CHUNK = 2000
+IMPORT_ERRORS_SHOWN = 10
+VCARD_SUFFIXES = {".vcf", ".vcard"}
+CSV_SUFFIXES = {".csv"}
+# formatting allowed around the 12 digits of an imported phone
+PHONE_PUNCTUATION = re.compile(r"[\s()+./-]")
+# a Record keeps a phone set beside its phone array from this many phones on
+PHONE_SET_MIN = 8
+DB_SUFFIX = ".db"
+# a directory of shard-<i>.json files, each served by its own process
+SHARDS_SUFFIX = ".shards"
+SHARDS_ENV = "BOT_SHARDS"
+# written when a sharded book is created; the shard count can't be told from
+# the files, as a shard has none until it is first written
+SHARDS_MANIFEST = "shards.json"
+# open searches a shard keeps for the pages to come, see shard_page
+SHARD_CURSORS = 16
+SHARD_FILE = re.compile(r"shard-(\d+)\.json")
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    lname TEXT NOT NULL,
+    birthday TEXT,
+    bday TEXT,
+    email TEXT
+);
+CREATE TABLE IF NOT EXISTS phones (
+    contact_id INTEGER NOT NULL REFERENCES contacts(id),
+    phone TEXT NOT NULL,
+    UNIQUE (contact_id, phone)
+);
+CREATE INDEX IF NOT EXISTS contacts_bday ON contacts(bday);
+CREATE INDEX IF NOT EXISTS contacts_email ON contacts(email);
+CREATE INDEX IF NOT EXISTS phones_phone ON phones(phone);
+"""
+DB_GRAMS = "CREATE VIRTUAL TABLE IF NOT EXISTS contact_grams USING fts5(name, phones, tokenize='trigram')"
+# PRAGMA user_version; 1: contact_grams holds casefolded names, as lname does
+DB_VERSION = 1
+# Searches are literal unless prefixed; a regex search gets REGEX_BUDGET
+# seconds in total, so a pattern like (a+)+$ can't hang the bot
+REGEX_PREFIX = "re:"
+REGEX_BUDGET = 2.0
+FUZZY_PREFIX = "~"
+# how many of the most similar names a fuzzy search shows
+FUZZY_LIMIT = 20
+
+
+def grams(s: str) -> set:
+    return {s[i : i + GRAM_SIZE] for i in range(len(s) - GRAM_SIZE + 1)}
+
+
+def count_shared(postings: list, size, limit=FUZZY_LIMIT) -> Counter:
+    # How many of the text's trigrams each name has, given the set of names
+    # having each trigram and size(name), its number of distinct trigrams.
+    # Rarest first: a name not seen after i of m trigrams has a similarity of
+    # at most (m - i) / m, so once that is below the `limit`-th best so far,
+    # the rest only add to the names counted.
+    m = len(postings)
+    shared = Counter()
+    closed = False
+    for i, names in enumerate(sorted(postings, key=len)):
+        if not closed and len(shared) >= limit:
+            # partial counts give lower bounds
+            best = [k / (m + size(x) - k) for x, k in shared.most_common(limit)]
+            closed = (m - i) / m < min(best)
+        shared.update(shared.keys() & names if closed else names)
+    return shared
+
+
+def rank_similar(wanted: set, shared: Counter, size, limit=FUZZY_LIMIT) -> list:
+    # (similarity, name) pairs, best first, given the trigrams of the text,
+    # how many of them each name has and size(name) as for count_shared.
+    # Similarity is the Jaccard index of the two trigram sets.
+    m = len(wanted)
+    return nsmallest(
+        limit, ((k / (m + size(x) - k), x) for x, k in shared.items() if k), key=lambda x: (-x[0], x[1])
+    )
+
+
+def gram_count(name: str) -> int:
+    return len(grams(name.casefold()))
+
+
+# "key": {flat object} followed by ',' or '}': a contact as written by
+# write_json_object, found without decoding it. A brace inside a string can
+# end the match early; iter_json_object checks for that.
+RAW_ENTRY = re.compile(r'\s*"([^"\\]*)"\s*:\s*(\{[^{}]*\})\s*([,}])')
+
+
+def iter_json_object(f, chunk_size=CHUNK_SIZE, raw=False):
+    # Yield (key, value) pairs of a top-level JSON object, reading the file
+    # chunk by chunk so that only one entry is decoded at a time. With raw,
+    # a value that is a flat object, as contacts are, is yielded as its JSON
+    # text and left for the caller to decode when needed.
+    decode = json.JSONDecoder().raw_decode
+    skip = re.compile(r"[ \t\n\r]*").match
+    buf = f.read(chunk_size)
+    while not buf.strip() and (chunk := f.read(chunk_size)):
+        buf += chunk
+    pos = skip(buf).end()
+    if buf[pos : pos + 1] != "{":
+        raise json.JSONDecodeError("Expecting '{'", buf, pos)
+    pos += 1
+    can_close = True
+    while True:
+        try:
+            if raw:
+                # without backslashes, an odd number of quotes means the match
+                # stopped at a brace inside a string; such entries are decoded
+                while (m := RAW_ENTRY.match(buf, pos)) and "\\" not in m[2] and not m[2].count('"') % 2:
+                    yield m[1], m[2]
+                    if m[3] == "}":
+                        return
+                    pos, can_close = m.end(), False
+            pos = skip(buf, pos).end()
+            if buf[pos] == "}" and can_close:
+                return
+            key, end = decode(buf, pos)
+            end = skip(buf, end).end()
+            if buf[end] != ":":
+                raise json.JSONDecodeError("Expecting ':'", buf, end)
+            value, end = decode(buf, skip(buf, end + 1).end())
+            end = skip(buf, end).end()
+            # an entry must be followed by ',' or '}' to be complete, so a
+            # value cut at the chunk boundary is re-read with the next chunk
+            if buf[end] not in ",}":
+                raise json.JSONDecodeError("Expecting ',' or '}'", buf, end)
+        except (IndexError, json.JSONDecodeError):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise json.JSONDecodeError("Unexpected end of address book", buf, pos)
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield key, value
+        can_close = buf[end] == "}"
+        pos = end if can_close else end + 1
+
+
+def write_atomic(path: Path, write, codec=None):
+    # Write to a temporary file and rename it over path, so readers never see
+    # a partially written file; codec is gzip.open or lzma.open to compress
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb", buffering=WRITE_BUFFER) as raw:
+        if codec:
+            with codec(raw, "wt", encoding="utf-8", newline="") as f:
+                write(f)
+        else:
+            f = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            write(f)
+            f.detach()
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+
+
+def snapshot_codec(path: Path):
+    # gzip.open or lzma.open for a compressed snapshot, told by the magic
+    # bytes of an existing file or else by the suffix; None for plain JSON
+    if path.exists():
+        with open(path, "rb") as f:
+            head = f.read(6)
+        return next((c for magic, c in SNAPSHOT_MAGIC.items() if head.startswith(magic)), None)
+    return SNAPSHOT_SUFFIXES.get(path.suffix.lower())
+
+
+def write_columns(f, contacts, block_size=SNAPSHOT_BLOCK):
+    # The key of each contact is its name, so it is not stored again
+    f.write(json.dumps({"format": SNAPSHOT_FORMAT}) + "\n")
+    contacts = iter(contacts)
+    while block := [v for _, v in islice(contacts, block_size)]:
+        f.write(json.dumps({x: [v[x] for v in block] for x in CONTACT_FIELDS}) + "\n")
+
+
+def iter_columns(f):
+    # (key, contact dict) pairs of a columnar snapshot, a block at a time
+    header = json.loads(f.readline())
+    if header.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unknown snapshot format {header.get('format')!r}")
+    for line in f:
+        block = json.loads(line)
+        for name, birthday, email, phone in zip(*(block[x] for x in CONTACT_FIELDS)):
+            yield name, {"name": name, "birthday": birthday, "email": email, "phone": phone}
+
+
+def write_json_object(f, contacts):
+    # The inverse of iter_json_object: write (key, contact dict) pairs one at
+    # a time, in json.dump's layout, without building the whole object; a
+    # contact still in its raw JSON text is copied as it is
+    f.write("{")
+    separator = ""
+    for k, v in contacts:
+        f.write(separator + json.dumps(k) + ": " + (v if isinstance(v, str) else json.dumps(v)))
+        separator = ", "
+    f.write("}")
+
+
+def write_ndjson(f, contacts):
+    for _, v in contacts:
+        f.write(json.dumps(v) + "\n")
+
+
+def write_csv(f, contacts):
+    # the layout iter_csv reads back: phones joined by ';'
+    writer = csv.writer(f)
+    writer.writerow(("name", "birthday", "email", "phone"))
+    for _, v in contacts:
+        writer.writerow((v["name"], v["birthday"] or "", v["email"] or "", ";".join(v["phone"])))
+
+
+def vcard_escape(value: str) -> str:
+    return re.sub(r"([\\,;])", r"\\\1", value)
+
+
+def write_vcard(f, contacts):
+    # vCard 3.0 with CRLF line ends; a birthday without a year is --mm-dd
+    for _, v in contacts:
+        lines = ["BEGIN:VCARD", "VERSION:3.0", "FN:" + vcard_escape(v["name"])]
+        if v["birthday"]:
+            lines.append("BDAY:" + ("--" if len(v["birthday"]) == 5 else "") + v["birthday"])
+        if v["email"]:
+            lines.append("EMAIL:" + v["email"])
+        lines.extend("TEL;TYPE=cell:" + p for p in v["phone"])
+        lines.append("END:VCARD")
+        f.write("\r\n".join(lines) + "\r\n")
+
+
+EXPORTERS = {
+    ".json": write_json_object,
+    ".ndjson": write_ndjson,
+    ".jsonl": write_ndjson,
+    ".csv": write_csv,
+    ".vcf": write_vcard,
+    ".vcard": write_vcard,
+}
+
+
+def import_contact(name, birthday, email, phones) -> dict:
+    # a contact dict shaped like the JSON book's, not validated yet
+    return {
+        "name": name or None,
+        "birthday": birthday or None,
+        "email": email or None,
+        "phone": [PHONE_PUNCTUATION.sub("", p) for p in phones if p.strip()],
+    }
+
+
+def iter_csv(f):
+    # (line number, contact dict) for each row of a CSV file whose header
+    # names the columns name, birthday, email and phone (phone2, ... for more
+    # numbers); a phone cell may list several numbers separated by ';' or ','
+    reader = csv.DictReader(f)
+    for row in reader:
+        row = {k.strip().lower(): (v or "").strip() for k, v in row.items() if isinstance(k, str)}
+        phones = [p for k, v in row.items() if k.startswith("phone") for p in re.split(r"[;,]", v)]
+        yield reader.line_num, import_contact(row.get("name"), row.get("birthday"), row.get("email"), phones)
+
+
+def unfold(f):
+    # (line number, line) of a vCard file with folded lines joined back: a
+    # line starting with a space or a tab continues the previous one
+    n, line = 0, None
+    for i, x in enumerate(f, 1):
+        x = x.rstrip("\r\n")
+        if line is not None and x[:1] in (" ", "\t"):
+            line += x[1:]
+            continue
+        if line is not None:
+            yield n, line
+        n, line = i, x
+    if line is not None:
+        yield n, line
+
+
+def vcard_date(value: str) -> str:
+    # BDAY as 'yyyy-mm-dd' or 'mm-dd': accepts 19991022, 1999-10-22, --1022
+    # and --10-22, with any time part dropped
+    value = value.split("T")[0].replace("-", "")
+    if len(value) == 4:
+        return f"{value[:2]}-{value[2:]}"
+    if len(value) == 8 and value.isdigit():
+        return f"{value[:4]}-{value[4:6]}-{value[6:]}"
+    return value
+
+
+def iter_vcard(f):
+    # (line number of BEGIN, contact dict) for each card, taking FN, BDAY,
+    # the first EMAIL and every TEL
+    card = None
+    for n, line in unfold(f):
+        key, _, value = line.partition(":")
+        prop = key.split(";")[0].split(".")[-1].upper()
+        value = re.sub(r"\\(.)", r"\1", value.strip())
+        if prop == "BEGIN" and value.upper() == "VCARD":
+            card = n, {"name": "", "birthday": "", "email": "", "phones": []}
+        elif card is None:
+            continue
+        elif prop == "END":
+            yield card[0], import_contact(**card[1])
+            card = None
+        elif prop == "FN":
+            card[1]["name"] = value
+        elif prop == "BDAY":
+            card[1]["birthday"] = vcard_date(value)
+        elif prop == "EMAIL" and not card[1]["email"]:
+            card[1]["email"] = value
+        elif prop == "TEL":
+            card[1]["phones"].append(value.removeprefix("tel:"))
+
+
+def validate_contacts(rows: list) -> tuple:
+    # import_contacts worker: run the Field validators over a chunk of
+    # (line number, contact dict) and return (contact dicts, errors)
+    valid, errors = [], []
+    for n, v in rows:
+        try:
+            if not v["name"]:
+                raise Exception("name is missing")
+            valid.append(Record.from_dict(v).to_dict())
+        except Exception as e:
+            errors.append((n, str(e)))
+    return valid, errors
+
+
+@lru_cache(maxsize=4)
+def occurrences(year: int) -> tuple:
+    # Ordinal of each month * 32 + day birthday in the given year (0 for
+    # impossible dates); Feb-29 falls on Feb-28 in common years. Cached, as
+    # every page render asks for the same two years
+    table = [0] * 13 * 32
+    for m in range(1, 13):
+        for day in range(1, 32):
+            try:
+                table[m * 32 + day] = date(year, m, day).toordinal()
+            except ValueError:
+                if m == 2 and day == 29:
+                    table[m * 32 + day] = date(year, 2, 28).toordinal()
+    return tuple(table)
+
+
+def days_to_birthdays(months: array, days: array, now=None) -> list:
+    # Batch Birthday.days_to_birthday over packed month/day arrays
+    now = now or datetime.today()
+    today = now.toordinal()
+    this_year, next_year = occurrences(now.year), occurrences(now.year + 1)
+    if np is not None:
+        idx = np.frombuffer(months, np.uint8).astype(np.intp) * 32 + np.frombuffer(days, np.uint8)
+        occ = np.asarray(this_year)[idx]
+        occ = np.where(occ < today, np.asarray(next_year)[idx], occ)
+        return (occ - today).tolist()
+    r = []
+    for m, day in zip(months, days):
+        occ = this_year[m * 32 + day]
+        if occ < today:
+            occ = next_year[m * 32 + day]
+        r.append(occ - today)
+    return r
+
+
+def days_left(records) -> list:
+    # days_to_birthdays for a list of Records; None where there is no birthday
+    months, days, pos = array("B"), array("B"), []
+    for i, record in enumerate(records):
+        if bd := record.birthday_key():
+            months.append(bd[0])
+            days.append(bd[1])
+            pos.append(i)
+    r = [None] * len(records)
+    for i, x in zip(pos, days_to_birthdays(months, days)):
+        r[i] = x
+    return r
+
+
+def record_terms(value) -> tuple:
+    # (name, phones, (month, day) or None) of a Record or of a raw, not yet
+    # hydrated contact dict or its JSON text
+    if isinstance(value, str):
+        value = json.loads(value)
+    if isinstance(value, dict):
+        bd = value["birthday"] and tuple(int(x) for x in value["birthday"].split("-")[-2:])
+        return value["name"], value["phone"], bd
+    return value.name.value, value.phone_values(), value.birthday_key()
+
+
+class Query:
+    # A search string compiled once per select: a case-folded substring match
+    # by default, a regular expression when it starts with REGEX_PREFIX.
+    # Invalid patterns raise re.error here rather than on every record.
+    # FUZZY_PREFIX asks for the names most alike instead, see
+    # AddressBook.fuzzy; such a query ranks names rather than matching them.
+    def __init__(self, search_string: str):
+        self.regex = search_string.startswith(REGEX_PREFIX)
+        self.fuzzy = search_string.startswith(FUZZY_PREFIX)
+        if self.regex:
+            self.text = search_string[len(REGEX_PREFIX) :]
+        elif self.fuzzy:
+            self.text = search_string[len(FUZZY_PREFIX) :]
+        else:
+            self.text = search_string
+        self.digits = self.text.isdigit()
+        if self.regex:
+            self.name_re = re.compile(self.text.lower())
+            self.phone_re = re.compile(self.text)
+        else:
+            self.folded = self.text.casefold()
+        # queries with the same key match the same contacts
+        self.key = (self.regex, self.fuzzy, self.text if self.regex else self.folded)
+
+    def matches(self, value) -> bool:
+        # value is a Record or a raw contact dict, which is not hydrated
+        if len(self.text) <= 1:
+            return False
+        name, phones, _ = record_terms(value)
+        if self.regex:
+            if self.name_re.search(name.lower()):
+                return True
+            return self.digits and self.phone_re.search("!".join(phones)) is not None
+        if self.folded in name.casefold():
+            return True
+        return self.digits and any(self.text in p for p in phones)
+
+    def narrows(self, other) -> bool:
+        # True when every contact this query matches is matched by other too:
+        # a name or phone containing self.text contains other.text as well
+        return (
+            not (self.regex or self.fuzzy or other.regex or other.fuzzy)
+            and len(other.text) > 1
+            and other.folded in self.folded
+        )
+
+
+@contextmanager
+def time_budget(seconds):
+    # Raise TimeoutError inside the block once `seconds` have passed. It
+    # relies on SIGALRM, so it does nothing on Windows, outside the main
+    # thread or when seconds is None.
+    if (
+        seconds is None
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+    if seconds <= 0:
+        raise TimeoutError("Search time limit exceeded")
+
+    def expire(signum, frame):
+        raise TimeoutError("Search time limit exceeded")
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
 
 
 class Field:
+    __slots__ = ("__value",)
+
     def __init__(self, value=None):
         self.value = value
 
+    @classmethod
+    def trusted(cls, value):
+        # Build a field from an already validated value, skipping the setter
+        field = cls.__new__(cls)
+        Field.value.fset(field, value)
+        return field
+
     @property
     def value(self):
         return self.__value
@@ -88,6 +610,8 @@ class Field:
 
 
 class Phone(Field):
+    __slots__ = ()
+
     @Field.value.setter
     def value(self, value):
         if len(value := str(value)) == 12 and value.isdigit():
@@ -97,6 +621,8 @@ class Phone(Field):
 
 
 class Email(Field):
+    __slots__ = ()
+
     @Field.value.setter
     def value(self, value):
         if search(r"^\w+([-+.']\w+)*@\w+([-.]\w+)*\.\w+([-.]\w+)*$", value):
@@ -106,10 +632,12 @@ class Email(Field):
 
 
 class Name(Field):
-    ...
+    __slots__ = ()
 
 
 class Birthday(Field):
+    __slots__ = ()
+
     @Field.value.setter
     def value(self, value):
         x = str(MIN_YEAR) + "-" + value if search(r"^\d{1,2}-\d{1,2}$", value) else value
@@ -130,10 +658,12 @@ class Birthday(Field):
             return datetime(year=year, month=2, day=28)
 
     def days_to_birthday(self) -> int:
-        todays_date = datetime.today()
-        birthday = self.replace_year(todays_date.year)
+        # calendar days, so a birthday today is 0 days left and tomorrow's
+        # is 1, as upcoming_birthdays counts them
+        todays_date = date.today()
+        birthday = self.replace_year(todays_date.year).date()
         if todays_date > birthday:
-            birthday = self.replace_year(todays_date.year + 1)
+            birthday = self.replace_year(todays_date.year + 1).date()
         return (birthday - todays_date).days
 
     def std_str(self, mode=None) -> str:
@@ -142,128 +672,1555 @@ class Birthday(Field):
             format_string = "%m-%d" if self.value.year == MIN_YEAR else "%Y-%m-%d"
         return self.value.strftime(format_string)
 
+    def to_str(self, days_left=None) -> str:
+        if days_left is None:
+            days_left = self.days_to_birthday()
+        return f"{self.std_str()} ({days_left} days left)"
+
     def __str__(self) -> str:
-        return f"{self.std_str()} ({self.days_to_birthday()} days left)"
+        return self.to_str()
 
 
 class Record:
+    # Phones are kept as 12-digit integers in an array('Q'), the birthday as a
+    # date ordinal (0 = none), name and e-mail as plain strings; the public
+    # attributes rebuild the Field objects on access. Contacts with many
+    # phones also get a set of them, so membership tests stay O(1).
+    __slots__ = ("__name", "__birthday", "__email", "__phones", "__phone_set")
+
     def __init__(self, name: Name, birthday=None, email=None, phone=None):
         self.name = name
-        self.phone = []
+        self.__phones = array("Q")
+        self.__phone_set = None
         if phone:
             self.add_phone(phone)
         self.birthday = birthday
         self.email = email
 
+    @property
+    def name(self) -> Name:
+        return Name.trusted(self.__name)
+
+    @name.setter
+    def name(self, name: Name):
+        self.__name = name.value
+
+    @property
+    def phone(self) -> list:
+        return [Phone.trusted(p) for p in self.phone_values()]
+
+    @phone.setter
+    def phone(self, phone):
+        self.__phones = array("Q")
+        self.__phone_set = None
+        self.add_phone(list(phone))
+
+    def phone_values(self) -> list:
+        return [f"{p:012}" for p in self.__phones]
+
+    @property
+    def birthday(self):
+        if self.__birthday:
+            return Birthday.trusted(datetime.fromordinal(self.__birthday))
+
+    @birthday.setter
+    def birthday(self, birthday):
+        self.__birthday = birthday.value.toordinal() if birthday else 0
+
+    def birthday_key(self):
+        if self.__birthday:
+            bd = date.fromordinal(self.__birthday)
+            return bd.month, bd.day
+
+    @property
+    def email(self):
+        if self.__email:
+            return Email.trusted(self.__email)
+
+    @email.setter
+    def email(self, email):
+        self.__email = email.value if email else None
+
     def is_phone(self, phone) -> bool:
-        return phone.value in set(p.value for p in self.phone) if self.phone else False
+        return int(phone.value) in (self.__phones if self.__phone_set is None else self.__phone_set)
 
     def add_phone(self, phone):
+        # Returns the number of phones actually added; a list is deduplicated
+        # in one pass against a single set
+        phones = phone if isinstance(phone, list) else [phone]
+        seen = set(self.__phones) if self.__phone_set is None else self.__phone_set
         add_counter = 0
-        if isinstance(phone, list):
-            for p in phone:
-                if not self.is_phone(p):
-                    self.phone.append(p)
-                    add_counter += 1
-        elif not self.is_phone(phone):
-            self.phone.append(phone)
-            add_counter = 1
+        for p in phones:
+            x = int(p.value)
+            if x not in seen:
+                seen.add(x)
+                self.__phones.append(x)
+                add_counter += 1
+        if self.__phone_set is None and len(self.__phones) >= PHONE_SET_MIN:
+            self.__phone_set = seen
         return add_counter
 
     def del_phone(self, phone):
         if self.is_phone(phone):
-            self.phone.remove(phone)
+            x = int(phone.value)
+            self.__phones.remove(x)
+            if self.__phone_set is not None:
+                self.__phone_set.discard(x)
             return True
 
+    @classmethod
+    def from_dict(cls, source: dict):
+        return cls(
+            Name(source["name"]),
+            birthday=Birthday(source["birthday"]) if source["birthday"] else None,
+            email=Email(source["email"]) if source["email"] else None,
+            phone=[Phone(x) for x in source["phone"]],
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name.value,
+            "birthday": self.birthday.std_str(mode=NUMBER_FORMAT) if self.birthday else None,
+            "email": self.__email,
+            "phone": self.phone_values(),
+        }
+
     def is_in(self, search_string: str) -> bool:
-        if len(search_string) <= 1:
-            return False
-        if search(search_string.lower(), self.name.value.lower()):
-            return True
-        if search_string.isdigit() and search(
-            search_string, "!".join(p.value for p in self.phone)
-        ):
-            return True
-        return False
+        return Query(search_string).matches(self)
+
+    def to_str(self, days_left=None) -> str:
+        phones = ", ".join(self.phone_values())
+        birthday = self.birthday.to_str(days_left) if self.birthday else None
+        return f"{str(self.name):<20} {str(birthday):<27} {str(self.email):<30} {phones:<20}"
 
     def __str__(self) -> str:
-        phones = ", ".join(str(p) for p in self.phone)
-        return f"{str(self.name):<20} {str(self.birthday):<27} {str(self.email):<30} {phones:<20}"
+        return self.to_str()
 
     def print_with_header(self):
         print("\n" + RECORD_HEADER + "\n   " + str(self) + "\n" + LINE + "\n")
 
 
+class RWLock:
+    # Many readers or one writer. `with lock:` takes it for writing and may be
+    # re-entered by the writer, which may also read; `with lock.read():` is
+    # shared and may be nested. Waiting writers hold off new readers so a
+    # steady stream of lookups can't starve an edit.
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.writes = 0
+        self.waiting = 0
+        self.local = threading.local()
+
+    @contextmanager
+    def read(self):
+        reads = getattr(self.local, "reads", 0)
+        if not reads and self.writer != threading.get_ident():
+            with self.cond:
+                while self.writer is not None or self.waiting:
+                    self.cond.wait()
+                self.readers += 1
+        self.local.reads = reads + 1
+        try:
+            yield
+        finally:
+            self.local.reads = reads
+            if not reads and self.writer != threading.get_ident():
+                with self.cond:
+                    self.readers -= 1
+                    if not self.readers:
+                        self.cond.notify_all()
+
+    def __enter__(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writes += 1
+                return self
+            if getattr(self.local, "reads", 0):
+                raise RuntimeError("a read lock can't be upgraded to a write lock")
+            self.waiting += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.waiting -= 1
+            self.writer, self.writes = me, 1
+        return self
+
+    def __exit__(self, *_):
+        with self.cond:
+            self.writes -= 1
+            if not self.writes:
+                self.writer = None
+                self.cond.notify_all()
+
+
+def reading(f):
+    # AddressBook method decorator: run under the book's shared read lock
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.read():
+            return f(self, *args, **kwargs)
+    return wrapper
+
+
+def writing(f):
+    # AddressBook method decorator: run under the book's exclusive lock, so
+    # a record-level edit and its index and journal updates are atomic
+    @wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return f(self, *args, **kwargs)
+    return wrapper
+
+
+class Autosave(threading.Thread):
+    # Debounced background writer: AddressBook.log_change queues journal
+    # lines and they are appended in one batch once no edit has come in for
+    # `delay` seconds; snapshot compaction then runs on this thread as well.
+    # A failed write (a full disk, say) is reported and retried every `delay`
+    # seconds with the lines kept; whatever is left at stop is for close().
+    def __init__(self, book, delay=AUTOSAVE_DELAY):
+        super().__init__(daemon=True)
+        self.book = book
+        self.delay = delay
+        self.queue = queue.Queue()
+        self.pending = []
+        self.error = None
+
+    def run(self):
+        while True:
+            try:
+                line = self.queue.get(timeout=self.delay if self.pending or self.error else None)
+            except queue.Empty:
+                line = ""
+            if line:
+                self.pending.append(line)
+            if (self.pending or self.error) and (not line or len(self.pending) >= JOURNAL_LIMIT):
+                self.flush()
+            if line is None:
+                return
+
+    def flush(self):
+        try:
+            if self.pending:
+                self.book.write_journal(self.pending)
+                self.pending = []
+            self.book.compact_if_due()
+        except Exception as e:
+            if self.error is None:
+                print(f"\nAutosave failed, retrying every {self.delay:g}s: {e}\n", file=sys.stderr)
+            self.error = e
+        else:
+            if self.error is not None:
+                print("\nAutosave recovered\n", file=sys.stderr)
+            self.error = None
+
+    def put(self, line: str):
+        self.queue.put(line)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def leftover(self) -> list:
+        # lines not written, including any still queued if the thread died
+        lines = self.pending
+        while not self.queue.empty():
+            line = self.queue.get_nowait()
+            if line:
+                lines.append(line)
+        return lines
+
+
+class SearchSession:
+    # Search-as-you-type over one book. It remembers the names the last
+    # query yielded and where its scan stopped; when the next query only
+    # narrows the last one, those names are re-checked and the scan goes on
+    # from there instead of searching the whole book again.
+    def __init__(self, book):
+        self.book = book
+        self.query = None
+        self.found = []
+        self.complete = False
+        self.generation = None
+
+    def select(self, size=PAGE_SIZE, search_string=None):
+        if not search_string:
+            self.query = None
+            yield from self.book.select(size, search_string)
+            return
+        query = Query(search_string)
+        # taken before refine, so a change made in between fails the next one
+        generation = self.book.generation
+        known = None
+        if self.query is not None and query.narrows(self.query):
+            known = self.book.refine(query, self.found, self.generation)
+        if known is None:
+            known, complete, start = [], False, ""
+        else:
+            # the old scan stopped right after its last name
+            complete, start = self.complete, self.found[-1] + "\0" if self.found else ""
+        self.query, self.found, self.complete, self.generation = query, [], False, generation
+        names = iter(known)
+        if not complete:
+            names = chain(names, chain.from_iterable(self.book.select(size, search_string, start)))
+        while True:
+            page = list(islice(names, size))
+            self.found.extend(page)
+            if len(page) < size:
+                self.complete = True
+            if not page:
+                return
+            yield page
+
+
 class AddressBook(UserDict):
-    def __init__(self, file_path=Path(DEFAULT_FILENAME)):
+    def __init__(self, file_path=Path(DEFAULT_FILENAME), lazy=True):
+        # n-gram -> set of names and (month, day) -> set of names, built on
+        # the first search and then kept in sync by __setitem__/__delitem__
+        self.name_grams = defaultdict(set)
+        # name -> its number of distinct name trigrams, for fuzzy ranking
+        self.name_gram_count = {}
+        self.phone_grams = defaultdict(set)
+        self.calendar = defaultdict(set)
+        # phone -> set of names, and the sorted list of distinct phones for
+        # prefix lookups, built on first use like self.order
+        self.phone_owners = defaultdict(set)
+        self.phone_order = None
+        self.indexed = False
+        # query key -> (Query, sorted names) of complete search results; a
+        # change to a record drops only the entries it matched before or after
+        self.query_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # bumped by every change, so a search that saw one isn't cached
+        self.generation = 0
+        # sorted list of names for show-all paging, built on first use
+        self.order = None
+        # lazy: keep each contact as its JSON text (as dicts when loaded from
+        # a columns snapshot) and build Records on first access
+        self.lazy = lazy
         super().__init__()
         self.file_path = file_path
+        self.journal_path = file_path.with_name(file_path.name + JOURNAL_SUFFIX)
+        # journal being folded into the snapshot by compact()
+        self.old_journal_path = self.journal_path.with_name(self.journal_path.name + ".old")
+        # see RWLock; index_lock lets one reader build the lazy indexes
+        self.lock = RWLock()
+        self.index_lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.autosave = None
         self.read_from_file()
 
-    def add_record(self, record: Record, print_msg=True):
-        self.data[record.name.value] = record
+    @reading
+    def __getitem__(self, key) -> Record:
+        value = self.data[key]
+        if isinstance(value, str):
+            value = json.loads(value)
+        if isinstance(value, dict):
+            value = self.data[key] = Record.from_dict(value)
+        return value
+
+    @writing
+    def __setitem__(self, key, record):
+        if key in self.data:
+            self.unindex(key, self.data[key])
+        elif self.order is not None:
+            insort(self.order, key)
+        self.data[key] = record
+        self.index(key, record)
+
+    @writing
+    def __delitem__(self, key):
+        self.unindex(key, self.data.pop(key))
+        if self.order is not None:
+            del self.order[bisect_left(self.order, key)]
+
+    def build_index(self):
+        # Called by readers, which may race here: one builds, the others
+        # wait, and the flag is only raised once the indexes are complete
+        with self.index_lock:
+            if not self.indexed:
+                for k, v in self.data.items():
+                    self.index(k, v, force=True)
+                self.indexed = True
+
+    def index(self, key, record, force=False):
+        if not force:
+            self.invalidate(record)
+        if not (self.indexed or force):
+            return
+        name, phones, bd = record_terms(record)
+        name_grams = grams(name.casefold())
+        for g in name_grams:
+            self.name_grams[g].add(key)
+        self.name_gram_count[key] = len(name_grams)
+        for p in phones:
+            for g in grams(p):
+                self.phone_grams[g].add(key)
+            if p not in self.phone_owners and self.phone_order is not None:
+                insort(self.phone_order, p)
+            self.phone_owners[p].add(key)
+        if bd:
+            self.calendar[bd].add(key)
+
+    def unindex(self, key, record):
+        self.invalidate(record)
+        if not self.indexed:
+            return
+        name, phones, bd = record_terms(record)
+        for g in grams(name.casefold()):
+            self.discard_gram(self.name_grams, g, key)
+        self.name_gram_count.pop(key, None)
+        for p in phones:
+            for g in grams(p):
+                self.discard_gram(self.phone_grams, g, key)
+            self.discard_gram(self.phone_owners, p, key)
+            if p not in self.phone_owners and self.phone_order is not None:
+                del self.phone_order[bisect_left(self.phone_order, p)]
+        if bd:
+            self.discard_gram(self.calendar, bd, key)
+
+    def invalidate(self, record):
+        # index/unindex see every record before and after each change. A
+        # regex may backtrack for long on the new name, and this runs under
+        # the write lock without a time budget, so regex entries are dropped
+        # on any change rather than matched.
+        with self.cache_lock:
+            self.generation += 1
+            stale = [k for k, (query, _) in self.query_cache.items() if query.regex or query.matches(record)]
+            for k in stale:
+                del self.query_cache[k]
+
+    def cached_names(self, query: Query):
+        with self.cache_lock:
+            entry = self.query_cache.get(query.key)
+            if entry is None:
+                self.cache_misses += 1
+                return None
+            self.cache_hits += 1
+            self.query_cache.move_to_end(query.key)
+            return entry[1]
+
+    def cache_names(self, query: Query, names: list, generation: int):
+        with self.cache_lock:
+            if generation != self.generation:
+                return
+            self.query_cache[query.key] = query, names
+            if len(self.query_cache) > QUERY_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+
+    @reading
+    def refine(self, query: Query, names: list, generation: int):
+        # names that also match the narrower query, or None when the book
+        # has changed since they were found
+        if generation != self.generation:
+            return None
+        return [k for k in names if query.matches(self.data[k])]
+
+    def search_session(self) -> SearchSession:
+        return SearchSession(self)
+
+    def cache_info(self) -> dict:
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self.query_cache),
+            "maxsize": QUERY_CACHE_SIZE,
+        }
+
+    @staticmethod
+    def discard_gram(gram_index: dict, gram: str, name: str):
+        if gram in gram_index:
+            gram_index[gram].discard(name)
+            if not gram_index[gram]:
+                del gram_index[gram]
+
+    def candidates(self, query: Query):
+        # None means the index can't narrow the search (regex or short query)
+        if query.regex or len(query.text) < GRAM_SIZE:
+            return None
+        if not self.indexed:
+            self.build_index()
+        r = self.lookup(self.name_grams, query.folded)
+        if query.digits:
+            r |= self.lookup(self.phone_grams, query.text)
+        return r
+
+    @reading
+    def fuzzy(self, text: str, limit=FUZZY_LIMIT) -> list:
+        # (similarity, name) of the names spelled most like text, best first;
+        # the name trigram index counts the trigrams each name shares with it
+        wanted = grams(text.casefold())
+        if not wanted:
+            return []
+        if not self.indexed:
+            self.build_index()
+        size = self.name_gram_count.__getitem__
+        shared = count_shared([self.name_grams.get(g, set()) for g in wanted], size, limit)
+        return rank_similar(wanted, shared, size, limit)
+
+    @reading
+    def find_birthday(self, month: int, day: int) -> list:
+        if not self.indexed:
+            self.build_index()
+        return sorted(self.calendar.get((month, day), ()))
+
+    @reading
+    def owners(self, phone: str) -> list:
+        # names of the contacts listing exactly this phone
+        if not self.indexed:
+            self.build_index()
+        return sorted(self.phone_owners.get(phone, ()))
+
+    def phone_range(self, prefix: str) -> tuple:
+        # [i, j) of the phones starting with prefix; ':' sorts right after '9'
+        if not self.indexed:
+            self.build_index()
+        if self.phone_order is None:
+            self.phone_order = sorted(self.phone_owners)
+        return bisect_left(self.phone_order, prefix), bisect_left(self.phone_order, prefix + ":")
+
+    @reading
+    def find_phone(self, prefix: str) -> list:
+        i, j = self.phone_range(prefix)
+        return sorted(set().union(*(self.phone_owners[p] for p in self.phone_order[i:j])))
+
+    @reading
+    def count_phones(self, prefix: str) -> int:
+        i, j = self.phone_range(prefix)
+        return j - i
+
+    @reading
+    def duplicate_phones(self) -> dict:
+        # phone -> names, for phones listed by more than one contact
+        if not self.indexed:
+            self.build_index()
+        return {p: sorted(v) for p, v in sorted(self.phone_owners.items()) if len(v) > 1}
+
+    @reading
+    def upcoming_birthdays(self, days=BIRTHDAY_DAYS) -> list:
+        # Walk the calendar from today; Feb-29 birthdays fall on Feb-28 in
+        # common years, as in Birthday.replace_year
+        today = date.today()
+        seen = set()
+        names = []
+        for i in range(min(days, 366) + 1):
+            x = today + timedelta(days=i)
+            keys = [(x.month, x.day)]
+            if keys[0] == (2, 28) and not isleap(x.year):
+                keys.append((2, 29))
+            for k in keys:
+                if k not in seen:
+                    seen.add(k)
+                    names.extend(self.find_birthday(*k))
+        return names
+
+    def select_birthdays(self, size=PAGE_SIZE, days=BIRTHDAY_DAYS):
+        names = self.upcoming_birthdays(days)
+        for i in range(0, len(names), size):
+            yield names[i : i + size]
+
+    @staticmethod
+    def lookup(gram_index: dict, s: str) -> set:
+        postings = sorted((gram_index.get(g, set()) for g in grams(s)), key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+    def log_change(self, op: str, name):
+        # Record-level write-ahead entry, durable once append_journal returns;
+        # with autosave running it is handed to the background writer instead
+        entry = {"op": op, "key": name}
+        if op != "delete":
+            entry["record"] = self[name].to_dict()
         self.save_changes = True
+        if self.autosave:
+            self.autosave.put(json.dumps(entry) + "\n")
+        else:
+            self.append_journal([json.dumps(entry) + "\n"])
+
+    def append_journal(self, lines: list):
+        self.write_journal(lines)
+        self.compact_if_due()
+
+    @stats.timer("io:journal")
+    def write_journal(self, lines: list):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_size += len(lines)
+
+    def compact_if_due(self):
+        if self.journal_size >= JOURNAL_LIMIT:
+            self.compact()
+        elif self.autosave and self.autosave.queue.empty():
+            self.save_changes = False
+
+    def start_autosave(self, delay=AUTOSAVE_DELAY):
+        self.autosave = Autosave(self, delay)
+        self.autosave.start()
+        atexit.register(self.close)
+
+    def close(self):
+        # flush whatever the autosave thread still holds, and write here
+        # what it couldn't
+        if self.autosave:
+            autosave, self.autosave = self.autosave, None
+            autosave.stop()
+            lines = autosave.leftover()
+            if lines:
+                self.append_journal(lines)
+
+    def replay_journal(self, journal_path: Path):
+        with open(journal_path, "r+b") as f:
+            good = 0
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated line")
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn tail left by a crash during append: cut it off, or
+                    # the next append would be glued onto it and lost
+                    f.truncate(good)
+                    break
+                good += len(line)
+                if entry["op"] == "delete":
+                    if entry["key"] in self.data:
+                        del self[entry["key"]]
+                elif self.lazy:
+                    self[entry["key"]] = json.dumps(entry["record"])
+                else:
+                    self[entry["key"]] = Record.from_dict(entry["record"])
+                self.journal_size += 1
+
+    @writing
+    def add_record(self, record: Record, print_msg=True):
+        op = "update" if record.name.value in self else "add"
+        self[record.name.value] = record
+        self.log_change(op, record.name.value)
         if print_msg:
             print(f"\nContact '{record.name.value}' successfully added.\n")
 
+    @writing
     def delete_record(self, name):
-        if name in self.data:
-            del self.data[name]
-            self.save_changes = True
+        if name in self:
+            del self[name]
+            self.log_change("delete", name)
+
+    @writing
+    def add_phone(self, name, phone) -> int:
+        record = self[name]
+        self.unindex(name, record)
+        n = record.add_phone(phone)
+        self.index(name, record)
+        if n:
+            self.log_change("update", name)
+        return n
+
+    @writing
+    def del_phone(self, name, phone):
+        record = self[name]
+        self.unindex(name, record)
+        r = record.del_phone(phone)
+        self.index(name, record)
+        if r:
+            self.log_change("update", name)
+        return r
+
+    @writing
+    def update_field(self, name, field: str, value):
+        record = self[name]
+        self.unindex(name, record)
+        setattr(record, field, value)
+        self.index(name, record)
+        self.log_change("update", name)
+
+    @reading
+    def days_to_birthdays(self, names) -> list:
+        return days_left([self[n] for n in names])
+
+    @reading
+    def render(self, names) -> list:
+        records = [self[n] for n in names]
+        return [r.to_str(x) for r, x in zip(records, days_left(records))]
 
     def __str__(self) -> str:
-        return RECORD_HEADER + "\n".join(str(v) for v in self.values())
+        return RECORD_HEADER + "\n".join(self.render(self.keys()))
 
-    def select(self, size=PAGE_SIZE, search_string=None):
+    def iter_names(self, start=""):
+        # Names in sorted order from the first one >= start. The list is read
+        # in slices and bisected again after each one, so edits made while
+        # the caller is paging don't shift the listing.
+        if self.order is None:
+            self.order = sorted(self.data)
+        i = bisect_left(self.order, start)
+        while chunk := self.order[i : i + ORDER_CHUNK]:
+            yield from chunk
+            i = bisect_right(self.order, chunk[-1])
+
+    def select(self, size=PAGE_SIZE, search_string=None, start=""):
+        # Pages are produced on demand: a search walks the names in order and
+        # stops as soon as a page is full, so the first page doesn't wait for
+        # the whole book to be scanned. A search from the start that runs to
+        # the end without a change in between is cached; a repeated search
+        # then pages through the cached names.
+        names = self.iter_names(start)
+        budget = found = None
         if search_string:
-            names = sorted(k for k, v in self.data.items() if v.is_in(search_string))
+            query = Query(search_string)
+            if query.fuzzy:
+                yield from self.select_fuzzy(size, query)
+                return
+            with self.lock.read():
+                hit = self.cached_names(query)
+                if hit is not None:
+                    names = hit[bisect_left(hit, start) :]
+                elif (keys := self.candidates(query)) is not None:
+                    names = sorted(k for k in keys if k >= start)
+                generation = self.generation
+            if hit is not None:
+                names = (k for k in names if k in self.data)
+            else:
+                names = (k for k in names if k in self.data and query.matches(self.data[k]))
+                if query.regex:
+                    budget = REGEX_BUDGET
+                if not start and len(query.text) > 1:
+                    found = []
         else:
-            names = sorted(self.data.keys())
+            names = (k for k in names if k in self.data)
+        while True:
+            # only time spent filling pages counts, not the time the caller
+            # spends reading them
+            t = perf_counter()
+            with self.lock.read(), time_budget(budget):
+                page = list(islice(names, size))
+            if found is not None:
+                found.extend(page)
+                if len(page) < size:
+                    self.cache_names(query, found, generation)
+            if not page:
+                return
+            if budget is not None:
+                budget -= perf_counter() - t
+            yield page
+
+    def select_fuzzy(self, size, query: Query):
+        # ranked best first, so `start` doesn't apply
+        names = [k for _, k in self.fuzzy(query.text)]
         for i in range(0, len(names), size):
             yield names[i : i + size]
 
     def from_dict(self, source_dict: dict):
         for k, v in source_dict.items():
-            self.data[k] = Record(
-                Name(v["name"]),
-                birthday=Birthday(v["birthday"]) if v["birthday"] else None,
-                email=Email(v["email"]) if v["email"] else None,
-                phone=[Phone(x) for x in v["phone"]],
-            )
+            self[k] = Record.from_dict(v)
+
+    def merge(self, contacts: dict):
+        # Add validated contact dicts in one batch: a single snapshot write
+        # instead of a journal entry per contact
+        if not contacts:
+            return
+        with self.lock:
+            # cheaper than checking every cached query against each contact
+            with self.cache_lock:
+                self.query_cache.clear()
+            for k, v in contacts.items():
+                self[k] = json.dumps(v) if self.lazy else Record.from_dict(v)
+        self.compact()
 
+    def import_contacts(self, file_path: Path, workers=None, chunk_size=IMPORT_CHUNK) -> tuple:
+        # Stream a CSV or vCard file, validate it in chunks across worker
+        # processes and merge the valid contacts at the end. Returns the
+        # number of contacts imported and the (line number, error) of every
+        # rejected row; later rows win over earlier ones with the same name.
+        parse = iter_vcard if file_path.suffix.lower() in VCARD_SUFFIXES else iter_csv
+        workers = workers or os.cpu_count() or 1
+        contacts, errors = {}, []
+
+        def collect(future):
+            valid, rejected = future.result()
+            contacts.update((v["name"], v) for v in valid)
+            errors.extend(rejected)
+
+        with open(file_path, "r", encoding="utf-8-sig", newline="") as f, ProcessPoolExecutor(workers) as pool:
+            # at most two chunks per worker in flight, so the file is never
+            # read much further ahead than the validation
+            pending = deque()
+            rows = parse(f)
+            while chunk := list(islice(rows, chunk_size)):
+                pending.append(pool.submit(validate_contacts, chunk))
+                if len(pending) >= 2 * workers:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+        self.merge(contacts)
+        return len(contacts), errors
+
+    @stats.timer("io:read_from_file")
     def read_from_file(self):
         self.save_changes = False
+        self.journal_size = 0
+        self.codec = snapshot_codec(self.file_path)
         if self.file_path.exists():
-            with open(self.file_path, "r", encoding="utf-8") as f:
-                self.from_dict(json.load(f))
+            if self.codec:
+                f, parse = self.codec(self.file_path, "rt", encoding="utf-8"), iter_columns
+            else:
+                f = open(self.file_path, "r", encoding="utf-8")
+                parse = partial(iter_json_object, raw=self.lazy)
+            with f:
+                for k, v in parse(f):
+                    self.data[k] = v if self.lazy else Record.from_dict(v)
+        for journal_path in (self.old_journal_path, self.journal_path):
+            if journal_path.exists():
+                self.replay_journal(journal_path)
 
+    @reading
     def to_dict(self) -> dict:
-        return {
-            k: {
-                "name": v.name.value,
-                "birthday": v.birthday.std_str(mode=NUMBER_FORMAT)
-                if v.birthday else None,
-                "email": v.email.value if v.email else None,
-                "phone": [p.value for p in v.phone],
+        return {k: self[k].to_dict() for k in self.data}
+
+    def iter_contacts(self, items=None, raw=False):
+        # (key, contact dict) pairs, one record at a time; raw contacts of a
+        # lazy book are decoded without building Records, or with raw passed
+        # through as JSON text for write_json_object
+        for k, v in items if items is not None else self.data.items():
+            if isinstance(v, str):
+                yield k, v if raw else json.loads(v)
+            else:
+                yield k, v if isinstance(v, dict) else v.to_dict()
+
+    def export(self, file_path: Path):
+        # Stream the book to a file whose format follows its suffix (see
+        # EXPORTERS); edits wait until it is written
+        write = EXPORTERS[file_path.suffix.lower()]
+        with self.lock.read():
+            write_atomic(file_path, lambda f: write(f, self.iter_contacts()))
+
+    @stats.timer("io:compact")
+    def compact(self):
+        # Fold the journal into the snapshot. The journal is set aside first
+        # so that edits made meanwhile go to a fresh one; replay is
+        # idempotent, so a crash at any point only means it is applied twice.
+        # Only references to the keys and values are copied; each record is
+        # converted and written on its own, outside the lock.
+        with self.lock:
+            # one compact at a time (merge and autosave may race): taken under
+            # self.lock, which callers may hold, and kept until written
+            self.compact_lock.acquire()
+            try:
+                keys, values = list(self.data), list(self.data.values())
+                if self.journal_path.exists():
+                    if self.old_journal_path.exists():
+                        # left by a compact that failed; keep both in order
+                        with open(self.old_journal_path, "ab") as dst, open(self.journal_path, "rb") as src:
+                            shutil.copyfileobj(src, dst)
+                        self.journal_path.unlink()
+                    else:
+                        os.replace(self.journal_path, self.old_journal_path)
+                self.journal_size = 0
+            except BaseException:
+                self.compact_lock.release()
+                raise
+        try:
+            if self.codec:
+                write, contacts = write_columns, self.iter_contacts(zip(keys, values))
+            else:
+                write, contacts = write_json_object, self.iter_contacts(zip(keys, values), raw=True)
+            write_atomic(self.file_path, lambda f: write(f, contacts), self.codec)
+            self.old_journal_path.unlink(missing_ok=True)
+        finally:
+            self.compact_lock.release()
+
+    def write_to_file(self, force=False):
+        # Every change is already journaled; only rewrite the snapshot when
+        # asked to or when the journal has grown past JOURNAL_LIMIT
+        self.close()
+        if force or self.journal_size >= JOURNAL_LIMIT:
+            self.compact()
+        self.save_changes = False
+
+
+class SqliteAddressBook(AddressBook):
+    # Contacts live in an SQLite file instead of self.data, so the book is
+    # not limited by memory; every edit is committed as one transaction.
+
+    def read_from_file(self):
+        self.save_changes = False
+        self.journal_size = 0
+        # shared by the threads of a server, see RWLock
+        self.db = sqlite3.connect(self.file_path, check_same_thread=False)
+        self.db.create_function("regexp", 2, lambda p, s: search(p, s) is not None)
+        self.db.executescript(DB_SCHEMA)
+        try:
+            self.db.execute(DB_GRAMS)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5: fall back to scans inside SQLite
+            self.fts = False
+        if self.fts and self.db.execute("PRAGMA user_version").fetchone()[0] < DB_VERSION:
+            # the trigram table of an older book has names as given, which
+            # FTS5 folds differently from casefold ('ß' vs 'ss'); rebuild it
+            with self.db:
+                self.db.execute("DELETE FROM contact_grams")
+                self.db.execute(
+                    "INSERT INTO contact_grams (rowid, name, phones) SELECT id, lname, coalesce((SELECT"
+                    " group_concat(phone, ' ') FROM (SELECT phone FROM phones WHERE contact_id = contacts.id"
+                    " ORDER BY rowid)), '') FROM contacts"
+                )
+                self.db.execute(f"PRAGMA user_version = {DB_VERSION}")
+
+    @reading
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM contacts").fetchone()[0]
+
+    @reading
+    def __contains__(self, key):
+        return self.contact_id(key) is not None
+
+    def __iter__(self):
+        return (r[0] for r in self.db.execute("SELECT name FROM contacts ORDER BY name"))
+
+    @reading
+    def contact_id(self, key):
+        r = self.db.execute("SELECT id FROM contacts WHERE name = ?", (key,)).fetchone()
+        return r[0] if r else None
+
+    @reading
+    def __getitem__(self, key) -> Record:
+        r = self.db.execute(
+            "SELECT id, name, birthday, email FROM contacts WHERE name = ?", (key,)
+        ).fetchone()
+        if r is None:
+            raise KeyError(key)
+        phones = self.db.execute(
+            "SELECT phone FROM phones WHERE contact_id = ? ORDER BY rowid", (r[0],)
+        )
+        return Record.from_dict(
+            {"name": r[1], "birthday": r[2], "email": r[3], "phone": [p[0] for p in phones]}
+        )
+
+    @writing
+    def __setitem__(self, key, record: Record):
+        with self.db:
+            self.store(key, record)
+
+    @writing
+    def __delitem__(self, key):
+        with self.db:
+            if (contact_id := self.contact_id(key)) is None:
+                raise KeyError(key)
+            self.db.execute("DELETE FROM phones WHERE contact_id = ?", (contact_id,))
+            self.db.execute("DELETE FROM contacts WHERE id = ?", (contact_id,))
+            if self.fts:
+                self.db.execute("DELETE FROM contact_grams WHERE rowid = ?", (contact_id,))
+
+    def store(self, key, record):
+        # Upsert a Record or an already validated contact dict without
+        # committing; callers wrap it in a transaction
+        v = record if isinstance(record, dict) else record.to_dict()
+        self.db.execute(
+            "INSERT INTO contacts (name, lname, birthday, bday, email) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (name) DO UPDATE SET lname = excluded.lname,"
+            " birthday = excluded.birthday, bday = excluded.bday, email = excluded.email",
+            (key, key.casefold(), v["birthday"], v["birthday"] and v["birthday"][-5:], v["email"]),
+        )
+        contact_id = self.contact_id(key)
+        self.db.execute("DELETE FROM phones WHERE contact_id = ?", (contact_id,))
+        self.db.executemany(
+            "INSERT INTO phones (contact_id, phone) VALUES (?, ?)",
+            ((contact_id, p) for p in v["phone"]),
+        )
+        if self.fts:
+            self.db.execute("DELETE FROM contact_grams WHERE rowid = ?", (contact_id,))
+            self.db.execute(
+                "INSERT INTO contact_grams (rowid, name, phones) VALUES (?, ?, ?)",
+                (contact_id, key.casefold(), " ".join(v["phone"])),
+            )
+
+    def log_change(self, op: str, name):
+        # __setitem__/__delitem__ have already committed the change
+        pass
+
+    def start_autosave(self, delay=AUTOSAVE_DELAY):
+        # every edit is its own transaction, there is nothing to defer
+        pass
+
+    @writing
+    def add_phone(self, name, phone) -> int:
+        record = self[name]
+        n = record.add_phone(phone)
+        if n:
+            self[name] = record
+        return n
+
+    @writing
+    def del_phone(self, name, phone):
+        record = self[name]
+        r = record.del_phone(phone)
+        if r:
+            self[name] = record
+        return r
+
+    @writing
+    def update_field(self, name, field: str, value):
+        record = self[name]
+        setattr(record, field, value)
+        self[name] = record
+
+    def refine(self, query: Query, names: list, generation: int):
+        # changes aren't counted here, so a session always searches afresh
+        return None
+
+    @reading
+    def fuzzy(self, text: str, limit=FUZZY_LIMIT) -> list:
+        # FTS5 lists the names having each trigram, as name_grams does
+        wanted = grams(text.casefold())
+        if not wanted:
+            return []
+        if self.fts:
+            postings = []
+            for g in wanted:
+                rows = self.db.execute(
+                    "SELECT name FROM contacts WHERE id IN"
+                    " (SELECT rowid FROM contact_grams WHERE contact_grams MATCH ?)",
+                    ('name : "' + g.replace('"', '""') + '"',),
+                )
+                postings.append({r[0] for r in rows})
+            shared = count_shared(postings, gram_count, limit)
+        else:
+            shared = Counter()
+            for (k,) in self.db.execute("SELECT name FROM contacts"):
+                shared[k] = len(wanted & grams(k.casefold()))
+        return rank_similar(wanted, shared, gram_count, limit)
+
+    def search_clause(self, query: Query) -> tuple:
+        # (SQL condition, parameters) matching Query.matches
+        if query.regex:
+            return (
+                "(lname REGEXP ? OR ? AND EXISTS"
+                " (SELECT 1 FROM phones WHERE contact_id = contacts.id AND phone REGEXP ?))",
+                (query.text.lower(), query.digits, query.text),
+            )
+        where = (
+            "(instr(lname, ?) > 0 OR ? AND EXISTS (SELECT 1 FROM phones"
+            " WHERE contact_id = contacts.id AND instr(phone, ?) > 0))"
+        )
+        params = (query.folded, query.digits, query.text)
+        if self.fts and len(query.text) >= GRAM_SIZE:
+            columns = "{name phones}" if query.digits else "name"
+            match = columns + ' : "' + query.folded.replace('"', '""') + '"'
+            where = "id IN (SELECT rowid FROM contact_grams WHERE contact_grams MATCH ?) AND " + where
+            params = (match, *params)
+        return where, params
+
+    @reading
+    def fetch_names(self, sql: str, params: tuple, budget=None) -> list:
+        t = perf_counter()
+        try:
+            with time_budget(budget):
+                return [r[0] for r in self.db.execute(sql, params)]
+        except sqlite3.OperationalError as e:
+            # the timeout fires inside the REGEXP function and reaches us
+            # wrapped by sqlite
+            if budget is not None and perf_counter() - t >= budget:
+                raise TimeoutError("Search time limit exceeded") from e
+            raise
+
+    def select(self, size=PAGE_SIZE, search_string=None, start=""):
+        # keyset pagination over the name index: each page is one query that
+        # stops after `size` rows, so nothing is held in memory
+        where, params, budget = "1", (), None
+        if search_string:
+            query = Query(search_string)
+            if query.fuzzy:
+                yield from self.select_fuzzy(size, query)
+                return
+            if len(query.text) <= 1:
+                return
+            where, params = self.search_clause(query)
+            if query.regex:
+                budget = REGEX_BUDGET
+        op, last = ">=", start
+        while True:
+            t = perf_counter()
+            page = self.fetch_names(
+                f"SELECT name FROM contacts WHERE name {op} ? AND {where} ORDER BY name LIMIT ?",
+                (last, *params, size),
+                budget,
+            )
+            if not page:
+                return
+            if budget is not None:
+                budget -= perf_counter() - t
+            yield page
+            op, last = ">", page[-1]
+
+    @reading
+    def find_phone(self, prefix: str) -> list:
+        # ':' sorts right after '9', so this is an index range scan
+        return [
+            r[0]
+            for r in self.db.execute(
+                "SELECT DISTINCT name FROM contacts JOIN phones ON contact_id = id"
+                " WHERE phone >= ? AND phone < ? ORDER BY name",
+                (prefix, prefix + ":"),
+            )
+        ]
+
+    @reading
+    def owners(self, phone: str) -> list:
+        return [
+            r[0]
+            for r in self.db.execute(
+                "SELECT name FROM contacts JOIN phones ON contact_id = id WHERE phone = ? ORDER BY name",
+                (phone,),
+            )
+        ]
+
+    @reading
+    def count_phones(self, prefix: str) -> int:
+        return self.db.execute(
+            "SELECT count(DISTINCT phone) FROM phones WHERE phone >= ? AND phone < ?",
+            (prefix, prefix + ":"),
+        ).fetchone()[0]
+
+    @reading
+    def duplicate_phones(self) -> dict:
+        r = defaultdict(list)
+        for phone, name in self.db.execute(
+            "SELECT phone, name FROM phones JOIN contacts ON contact_id = id WHERE phone IN"
+            " (SELECT phone FROM phones GROUP BY phone HAVING count(*) > 1) ORDER BY phone, name"
+        ):
+            r[phone].append(name)
+        return dict(r)
+
+    @reading
+    def find_birthday(self, month: int, day: int) -> list:
+        return [
+            r[0]
+            for r in self.db.execute(
+                "SELECT name FROM contacts WHERE bday = ? ORDER BY name", (f"{month:02}-{day:02}",)
+            )
+        ]
+
+    @writing
+    def from_dict(self, source_dict: dict):
+        with self.db:
+            for k, v in source_dict.items():
+                self.store(k, Record.from_dict(v))
+
+    @writing
+    def merge(self, contacts: dict):
+        with self.db:
+            for k, v in contacts.items():
+                self.store(k, v)
+
+    @writing
+    def import_json(self, file_path: Path):
+        with open(file_path, "r", encoding="utf-8") as f, self.db:
+            for k, v in iter_json_object(f):
+                self.store(k, Record.from_dict(v))
+
+    @reading
+    def to_dict(self) -> dict:
+        return {k: self[k].to_dict() for k in self}
+
+    def iter_contacts(self, items=None):
+        # one query for the whole book, phones folded in by group_concat
+        for name, birthday, email, phones in self.db.execute(
+            "SELECT name, birthday, email, (SELECT group_concat(phone, ' ') FROM"
+            " (SELECT phone FROM phones WHERE contact_id = contacts.id ORDER BY rowid))"
+            " FROM contacts ORDER BY name"
+        ):
+            yield name, {
+                "name": name,
+                "birthday": birthday,
+                "email": email,
+                "phone": phones.split() if phones else [],
             }
-            for k, v in self.data.items()
-        }
 
-    def write_to_file(self):
-        if self.save_changes:
-            with open(self.file_path, "w", encoding="utf-8") as f:
-                json.dump(self.to_dict(), f)
-                self.save_changes = False
+    def export(self, file_path: Path):
+        write = EXPORTERS[file_path.suffix.lower()]
+        with self.lock.read():
+            write_atomic(file_path, lambda f: write(f, self.iter_contacts()))
+
+    def compact(self):
+        self.db.execute("VACUUM")
+
+    def write_to_file(self, force=False):
+        if force:
+            self.compact()
+        self.save_changes = False
+
+
+def shard_page(book, size, search_string, start) -> list:
+    # The parent asks for a search page by page, each from just after the
+    # last name; the select generator is kept between the calls, so a shard
+    # doesn't redo its search for every page and a search run to the end is
+    # cached like in a single book
+    cursors = book.__dict__.setdefault("cursors", OrderedDict())
+    pages = cursors.pop((size, search_string, start), None) or book.select(size, search_string, start)
+    page = next(pages, [])
+    if len(page) == size:
+        cursors[(size, search_string, page[-1] + "\0")] = pages
+        if len(cursors) > SHARD_CURSORS:
+            cursors.popitem(last=False)
+    return page
+
+
+def shard_contacts(book, start, size) -> list:
+    names = shard_page(book, size, None, start)
+    return list(book.iter_contacts((k, book.data[k]) for k in names))
+
+
+def shard_phones(book, prefix) -> list:
+    i, j = book.phone_range(prefix)
+    return book.phone_order[i:j]
+
+
+def shard_phone_owners(book) -> list:
+    with book.lock.read():
+        if not book.indexed:
+            book.build_index()
+        return sorted((p, sorted(v)) for p, v in book.phone_owners.items())
+
+
+# calls a shard answers besides the AddressBook methods themselves
+SHARD_CALLS = {
+    "page": shard_page,
+    "contacts": shard_contacts,
+    "phones": shard_phones,
+    "phone_owners": shard_phone_owners,
+}
+
+
+def shard_main(file_path: Path, conn):
+    # Worker process of a ShardedAddressBook: (method, args) in, ("ok",
+    # result) or ("error", exception) out, until None. Ctrl+C belongs to the
+    # menu in the parent, so the worker ignores it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    book = AddressBook(file_path)
+    while (request := conn.recv()) is not None:
+        method, args = request
+        try:
+            f = SHARD_CALLS.get(method)
+            result = f(book, *args) if f else getattr(book, method)(*args)
+        except Exception as e:
+            conn.send(("error", e))
+        else:
+            conn.send(("ok", result))
+    book.close()
+
+
+class ShardedAddressBook(AddressBook):
+    # Contacts are partitioned by a stable hash of the name across worker
+    # processes, one per shard file in the file_path directory, each with its
+    # own journal. Point operations go to the owning shard; select fans out
+    # and merges the sorted per-shard pages, so searches use every core.
+
+    def read_from_file(self):
+        self.save_changes = False
+        self.journal_size = 0
+        self.file_path.mkdir(parents=True, exist_ok=True)
+        n = self.shard_count()
+        self.rpc_lock = threading.Lock()
+        self.shards = []
+        for i in range(n):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=shard_main, args=(self.file_path / f"shard-{i}.json", child), daemon=True
+            )
+            process.start()
+            child.close()
+            self.shards.append((process, conn))
+        atexit.register(self.shutdown)
+
+    def shard_count(self) -> int:
+        # Names are hashed over a fixed number of shards, so opening the
+        # files with another count would lose contacts; it comes from the
+        # manifest, and SHARDS_ENV only applies to a new book
+        manifest = self.file_path / SHARDS_MANIFEST
+        found = {int(m[1]) for x in self.file_path.iterdir() if (m := SHARD_FILE.match(x.name))}
+        if manifest.exists():
+            with open(manifest, "r", encoding="utf-8") as f:
+                n = json.load(f)["shards"]
+        elif found:
+            raise ValueError(f"'{self.file_path}' has shard files but no {SHARDS_MANIFEST}")
+        else:
+            n = int(os.environ.get(SHARDS_ENV) or 0) or os.cpu_count() or 1
+            write_atomic(manifest, lambda f: json.dump({"shards": n}, f))
+        if max(found, default=-1) >= n:
+            raise ValueError(f"'{self.file_path}' has files for more than the {n} shard(s) in {SHARDS_MANIFEST}")
+        return n
+
+    def shutdown(self):
+        # workers flush their autosave and exit
+        with self.rpc_lock:
+            shards, self.shards = self.shards, []
+            for _, conn in shards:
+                conn.send(None)
+            for process, _ in shards:
+                process.join()
 
+    def shard(self, key) -> int:
+        # crc32 rather than hash(), which changes from run to run
+        return zlib.crc32(key.encode("utf-8")) % len(self.shards)
 
-if len(sys.argv) > 1:
-    pth = Path(sys.argv[1])
-    if pth.is_dir():
-        pth = pth / DEFAULT_FILENAME
-else:
-    pth = Path(DEFAULT_FILENAME)
+    def scatter(self, requests: dict) -> dict:
+        # {shard: (method, args)} -> {shard: result}; every request is sent
+        # before any reply is read, so the shards work in parallel
+        with self.rpc_lock:
+            for i, request in requests.items():
+                self.shards[i][1].send(request)
+            replies = {i: self.shards[i][1].recv() for i in requests}
+        for status, result in replies.values():
+            if status == "error":
+                raise result
+        return {i: result for i, (_, result) in replies.items()}
 
-d = AddressBook(pth)
+    def call(self, key, method: str, *args):
+        i = self.shard(key)
+        return self.scatter({i: (method, args)})[i]
+
+    def fan_out(self, method: str, *args) -> list:
+        return list(self.scatter({i: (method, args) for i in range(len(self.shards))}).values())
+
+    def route_names(self, method: str, names) -> list:
+        # call method(names) on the owning shards, results in names' order
+        names = list(names)
+        groups = defaultdict(list)
+        for k in names:
+            groups[self.shard(k)].append(k)
+        results = self.scatter({i: (method, (g,)) for i, g in groups.items()})
+        by_name = {k: x for i, g in groups.items() for k, x in zip(g, results[i])}
+        return [by_name[k] for k in names]
+
+    def __len__(self):
+        return sum(self.fan_out("__len__"))
+
+    def __contains__(self, key):
+        return self.call(key, "__contains__", key)
+
+    def __iter__(self):
+        for page in self.select(ORDER_CHUNK):
+            yield from page
+
+    def __getitem__(self, key) -> Record:
+        return self.call(key, "__getitem__", key)
+
+    def __setitem__(self, key, record):
+        self.call(key, "__setitem__", key, record)
+
+    def __delitem__(self, key):
+        self.call(key, "__delitem__", key)
+
+    def log_change(self, op: str, name):
+        # each shard journals its own edits
+        pass
+
+    def add_record(self, record: Record, print_msg=True):
+        self.call(record.name.value, "add_record", record, False)
+        if print_msg:
+            print(f"\nContact '{record.name.value}' successfully added.\n")
+
+    def delete_record(self, name):
+        self.call(name, "delete_record", name)
+
+    def add_phone(self, name, phone) -> int:
+        return self.call(name, "add_phone", name, phone)
+
+    def del_phone(self, name, phone):
+        return self.call(name, "del_phone", name, phone)
+
+    def update_field(self, name, field: str, value):
+        self.call(name, "update_field", name, field, value)
+
+    def select(self, size=PAGE_SIZE, search_string=None, start=""):
+        # Each shard keeps at least `size` names buffered ahead of the page
+        # being built, fetched by keyset from just after its last name, so
+        # no shard can run dry before the merged page is full
+        if search_string:
+            query = Query(search_string)
+            if query.fuzzy:
+                yield from self.select_fuzzy(size, query)
+                return
+            if len(query.text) <= 1:
+                return
+        n = len(self.shards)
+        buffers = [deque() for _ in range(n)]
+        starts = [start] * n
+        done = [False] * n
+        while True:
+            need = {
+                i: ("page", (size, search_string, starts[i]))
+                for i in range(n)
+                if not done[i] and len(buffers[i]) < size
+            }
+            for i, names in self.scatter(need).items():
+                buffers[i].extend(names)
+                if len(names) < size:
+                    done[i] = True
+                else:
+                    # the smallest string after the last name
+                    starts[i] = names[-1] + "\0"
+            heap = [(b[0], i) for i, b in enumerate(buffers) if b]
+            heapify(heap)
+            page = []
+            while heap and len(page) < size:
+                name, i = heappop(heap)
+                page.append(name)
+                buffers[i].popleft()
+                if buffers[i]:
+                    heappush(heap, (buffers[i][0], i))
+            if not page:
+                return
+            yield page
+
+    def find_birthday(self, month: int, day: int) -> list:
+        return list(merge_sorted(*self.fan_out("find_birthday", month, day)))
+
+    def owners(self, phone: str) -> list:
+        return list(merge_sorted(*self.fan_out("owners", phone)))
+
+    def find_phone(self, prefix: str) -> list:
+        return sorted(set().union(*self.fan_out("find_phone", prefix)))
+
+    def count_phones(self, prefix: str) -> int:
+        # a number may be listed in several shards, so count distinct ones
+        return sum(1 for _ in groupby(merge_sorted(*self.fan_out("phones", prefix))))
+
+    def duplicate_phones(self) -> dict:
+        r = {}
+        for phone, group in groupby(merge_sorted(*self.fan_out("phone_owners")), key=lambda x: x[0]):
+            names = sorted(k for _, v in group for k in v)
+            if len(names) > 1:
+                r[phone] = names
+        return r
+
+    def days_to_birthdays(self, names) -> list:
+        return self.route_names("days_to_birthdays", names)
+
+    def refine(self, query: Query, names: list, generation: int):
+        # the shards count their changes separately; search afresh
+        return None
+
+    def fuzzy(self, text: str, limit=FUZZY_LIMIT) -> list:
+        # a name's similarity doesn't depend on its shard
+        r = sorted(chain.from_iterable(self.fan_out("fuzzy", text, limit)), key=lambda x: (-x[0], x[1]))
+        return r[:limit]
+
+    def cache_info(self) -> dict:
+        # summed over the shards, except maxsize, which is per shard
+        r = defaultdict(int)
+        for info in self.fan_out("cache_info"):
+            for k, v in info.items():
+                r[k] = v if k == "maxsize" else r[k] + v
+        return dict(r)
+
+    def render(self, names) -> list:
+        return self.route_names("render", names)
+
+    def to_dict(self) -> dict:
+        return dict(self.iter_contacts())
+
+    def iter_contacts(self, items=None):
+        # shard by shard, ORDER_CHUNK contacts per request
+        for i in range(len(self.shards)):
+            start = ""
+            while chunk := self.scatter({i: ("contacts", (start, ORDER_CHUNK))})[i]:
+                yield from chunk
+                start = chunk[-1][0] + "\0"
+
+    def merge(self, contacts: dict):
+        groups = defaultdict(dict)
+        for k, v in contacts.items():
+            groups[self.shard(k)][k] = v
+        self.scatter({i: ("merge", (g,)) for i, g in groups.items()})
+
+    def import_json(self, file_path: Path, chunk_size=IMPORT_CHUNK):
+        # validated by the shards in parallel, one snapshot write each at the end
+        with open(file_path, "r", encoding="utf-8") as f:
+            items = iter_json_object(f)
+            while chunk := list(islice(items, chunk_size)):
+                groups = defaultdict(dict)
+                for k, v in chunk:
+                    groups[self.shard(k)][k] = v
+                self.scatter({i: ("from_dict", (g,)) for i, g in groups.items()})
+        self.compact()
+
+    def compact(self):
+        self.fan_out("compact")
+
+    def write_to_file(self, force=False):
+        self.fan_out("write_to_file", force)
+        self.save_changes = False
+
+    def start_autosave(self, delay=AUTOSAVE_DELAY):
+        self.fan_out("start_autosave", delay)
+
+    def close(self):
+        if self.shards:
+            self.fan_out("close")
+
+
+def open_book(file_path: Path) -> AddressBook:
+    if file_path.suffix == DB_SUFFIX:
+        return SqliteAddressBook(file_path)
+    if file_path.suffix == SHARDS_SUFFIX:
+        return ShardedAddressBook(file_path)
+    return AddressBook(file_path)
+
+
+def book_path() -> Path:
+    if len(sys.argv) > 1:
+        pth = Path(sys.argv[1])
+        if pth.is_dir() and pth.suffix != SHARDS_SUFFIX:
+            pth = pth / DEFAULT_FILENAME
+        return pth
+    return Path(DEFAULT_FILENAME)
+
+
+# Opened by the main block only: worker processes (shards, import
+# validation) import this module again when they are spawned rather than
+# forked, with __name__ set to "__mp_main__"
+d = None
+stats.count_records = lambda: len(d) if d is not None else None
+# the main menu's searches, so typing a longer pattern narrows the last one
+session = None
+
+
+def import_file(file_path: Path):
+    # JSON books go into a database book as they are; CSV and vCard files
+    # are validated row by row
+    suffix = file_path.suffix.lower()
+    try:
+        if suffix == ".json" and isinstance(d, (SqliteAddressBook, ShardedAddressBook)):
+            d.import_json(file_path)
+            print(f"\nAddress book '{file_path}' imported\n")
+            return
+        if suffix not in CSV_SUFFIXES | VCARD_SUFFIXES:
+            print(f"\nUnsupported file type '{file_path.suffix}'\n")
+            return
+        n, errors = d.import_contacts(file_path)
+    except UnicodeDecodeError:
+        print(f"\n'{file_path}' is not UTF-8 text, save it as UTF-8 and try again\n")
+        return
+    except (OSError, csv.Error, json.JSONDecodeError) as e:
+        print(f"\n{e}\n")
+        return
+    print(f"\n{n} contact(s) imported from '{file_path}', {len(errors)} row(s) rejected")
+    for line, error in errors[:IMPORT_ERRORS_SHOWN]:
+        print(f"  line {line}: {error}")
+    if len(errors) > IMPORT_ERRORS_SHOWN:
+        print(f"  ... and {len(errors) - IMPORT_ERRORS_SHOWN} more")
+    print()
+
+
+def warn_shared_phone(phone: str, name: str):
+    others = [x for x in d.owners(phone) if x != name]
+    if others:
+        print(f"Phone '{phone}' is also listed for: {', '.join(others)}")
 
 
 def add_sequence(user_input: str, selected: Record, action: int):
@@ -292,7 +2249,7 @@ def add_sequence(user_input: str, selected: Record, action: int):
                 print(f"\n{user_input} is already in Contact list")
                 return action, selected
             elif selected:
-                selected.name.value = user_input
+                selected.name = Name(user_input)
                 selected.print_with_header()
                 return A_ADD_BD, selected
             else:
@@ -327,6 +2284,8 @@ def add_sequence(user_input: str, selected: Record, action: int):
                 else:
                     selected.add_phone(p)
             d.add_record(selected)
+            for x in selected.phone_values():
+                warn_shared_phone(x, selected.name.value)
             selected.print_with_header()
             return A_MAIN, None
     elif action == A_ADD_BD:
@@ -357,8 +2316,7 @@ def edit_sequence(user_input: str, selected: Record, action: int):
                 else:
                     print(str(selected.phone[0]))
                     print(f"\nPhone '{selected.phone[0].value}' has been deleted.\n")
-                    d[selected.name.value].phone = []
-                    d.save_changes = True
+                    d.del_phone(selected.name.value, selected.phone[0])
             else:
                 print("\nPhone list is empty\n")
         elif user_input == "3":
@@ -369,13 +2327,11 @@ def edit_sequence(user_input: str, selected: Record, action: int):
         elif user_input == "5":
             if selected.email:
                 print(f"\nE-mail '{selected.email.value}' has been deleted.\n")
-                d[selected.name.value].email = None
-                d.save_changes = True
+                d.update_field(selected.name.value, "email", None)
         elif user_input == "6":
             if selected.birthday:
                 print(f"\nBirthday '{selected.birthday.std_str()}' has been deleted.\n")
-                d[selected.name.value].birthday = None
-                d.save_changes = True
+                d.update_field(selected.name.value, "birthday", None)
         elif user_input == "7":
             return A_EDIT_DELETE, selected
         else:
@@ -390,25 +2346,23 @@ def edit_sequence(user_input: str, selected: Record, action: int):
             except Exception as e:
                 print(e)
             else:
-                if d[selected.name.value].add_phone(p):
+                if d.add_phone(selected.name.value, p):
                     print(f"Phone '{x}' added.")
-                    d.save_changes = True
+                    warn_shared_phone(x, selected.name.value)
                 else:
                     print(f"Phone '{x}' already exists.")
     elif action == A_EDIT_DEL_PH:
         if user_input.isdigit() and 0 < int(user_input) < len(selected.phone):
             x = selected.phone[int(user_input)]
             print(f"\nPhone '{x.value}' has been deleted.\n")
-            d[selected.name.value].del_phone(x)
-            d.save_changes = True
+            d.del_phone(selected.name.value, x)
     elif action == A_EDIT_UPD_EM:
         try:
             email = Email(user_input)
         except:
             print(f"\n'{user_input}' is not a valid e-mail.\n")
         else:
-            d[selected.name.value].email = email
-            d.save_changes = True
+            d.update_field(selected.name.value, "email", email)
     elif action == A_EDIT_UPD_BD:
         try:
             birthday = Birthday(user_input)
@@ -416,13 +2370,45 @@ def edit_sequence(user_input: str, selected: Record, action: int):
             print(e)
         else:
             print(f"\nBirthday {birthday.std_str()} added.\n")
-            d[selected.name.value].birthday = birthday
-            d.save_changes = True
+            d.update_field(selected.name.value, "birthday", birthday)
     elif action == A_EDIT_DELETE and user_input.upper() == "Y":
         print(f"\nContact '{selected.name.value}' has been deleted\n")
         d.delete_record(selected.name.value)
         return A_MAIN, None
-    return A_EDIT, selected
+    # re-read the contact: storage backends may hand out fresh Record objects
+    return A_EDIT, d[selected.name.value]
+
+
+def ask(prompt: str) -> str:
+    # a prompt inside a menu function; the user's reading and typing time
+    # is kept out of its latency stats
+    with stats.waiting():
+        return input(prompt)
+
+
+def browse(pages):
+    try:
+        for x in pages:
+            print(RECORD_HEADER)
+            for i, row in enumerate(d.render(x)):
+                print("{:>2} ".format(i) + row)
+            try:
+                z = int(ask(PAGE_MESSAGE).strip())
+            except (ValueError, EOFError):
+                continue
+            except KeyboardInterrupt:
+                print()
+                return A_MAIN, None
+            else:
+                if 0 <= z < len(x):
+                    print(f"\nContact '{x[z]}' selected\n")
+                    return A_EDIT, d[x[z]]
+    except re.error as e:
+        print(f"\nInvalid regular expression: {e}\n")
+    except TimeoutError:
+        print(f"\nSearch stopped after {REGEX_BUDGET:g} seconds, try a simpler pattern\n")
+    print(LINE)
+    return A_MAIN, None
 
 
 def main_menu(user_input: str, selected: Record, action: int):
@@ -434,6 +2420,41 @@ def main_menu(user_input: str, selected: Record, action: int):
     elif user_input in d:
         print(f"\nContact '{user_input}' selected\n")
         return A_EDIT, d[user_input]
+    elif user_input == "stats":
+        print("\n" + str(stats) + "\n")
+        print("Search cache: " + ", ".join(f"{k} {v}" for k, v in d.cache_info().items()) + "\n")
+    elif user_input == "3":
+        try:
+            s = ask(BIRTHDAY_MESSAGE).strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return A_MAIN, None
+        days = int(s) if s.isdigit() else BIRTHDAY_DAYS
+        print(f"\nBirthdays in the next {days} day(s)\n")
+        return browse(d.select_birthdays(PAGE_SIZE, days))
+    elif user_input == "4":
+        try:
+            s = ask(IMPORT_MESSAGE).strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return A_MAIN, None
+        if s:
+            import_file(Path(s))
+    elif user_input == "5":
+        try:
+            s = ask(EXPORT_MESSAGE).strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return A_MAIN, None
+        if Path(s).suffix.lower() not in EXPORTERS:
+            print(f"\nUnsupported file type '{Path(s).suffix}'\n")
+        else:
+            try:
+                d.export(Path(s))
+            except OSError as e:
+                print(f"\n{e}\n")
+            else:
+                print(f"\n{len(d)} contact(s) exported to '{s}'\n")
     elif user_input == "2" or len(user_input) > 1:
         if user_input == "2":
             s = ""
@@ -441,22 +2462,9 @@ def main_menu(user_input: str, selected: Record, action: int):
         else:
             s = user_input
             print(f"\nSearch pattern = '{user_input}'\n")
-        for x in d.select(PAGE_SIZE, s):
-            print(RECORD_HEADER)
-            for i, n in enumerate(x):
-                print("{:>2} ".format(i) + str(d[n]))
-            try:
-                z = int(input(PAGE_MESSAGE).strip())
-            except (ValueError, EOFError):
-                continue
-            except KeyboardInterrupt:
-                print()
-                return A_MAIN, None
-            else:
-                if 0 <= z < len(x):
-                    print(f"\nContact '{x[z]}' selected\n")
-                    return A_EDIT, d[x[z]]
-        print(LINE)
+            if s.isdigit():
+                print(f"{d.count_phones(s)} phone number(s) start with '{s}'\n")
+        return browse(session.select(PAGE_SIZE, s))
     else:
         print("\nUnrecognized command\n")
     return A_MAIN, None
@@ -478,6 +2486,13 @@ menu_functions = {
 
 
 if __name__ == "__main__":
+    # bot4.py <book> <file>...: import JSON (into a .db book), CSV or vCard
+    # files before starting
+    d = open_book(book_path())
+    session = d.search_session()
+    for x in sys.argv[2:]:
+        import_file(Path(x))
+    d.start_autosave()
     action = A_MAIN
     selected = None
     while True:
@@ -497,4 +2512,5 @@ if __name__ == "__main__":
             s = CTRL_C
             print()
         finally:
-            action, selected = menu_functions[action](s, selected, action)
+            with stats.timed(f"{menu_functions[action].__name__}[{action}]"):
+                action, selected = menu_functions[action](s, selected, action)
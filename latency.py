@@ -0,0 +1,137 @@
+import os
+import json
+import atexit
+import threading
+from math import log
+from time import perf_counter
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+STATS_ENV = "BOT_STATS"
+# Log-scale histogram buckets: 1 us * BUCKET_BASE ** i
+BUCKET_MIN = 1e-6
+BUCKET_BASE = 1.1
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.records = None
+
+    def add(self, seconds: float, records=None):
+        i = int(log(seconds / BUCKET_MIN, BUCKET_BASE)) if seconds > BUCKET_MIN else 0
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if records is not None:
+            self.records = records
+
+    def percentile(self, p: float) -> float:
+        # upper bound of the bucket holding the p-th percentile sample
+        rank = self.count * p / 100
+        n = 0
+        for i in sorted(self.buckets):
+            n += self.buckets[i]
+            if n >= rank:
+                return min(BUCKET_MIN * BUCKET_BASE ** (i + 1), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        r = {"count": self.count, "total": self.total, "max": self.max}
+        r.update({f"p{p}": self.percentile(p) for p in PERCENTILES})
+        if self.records is not None:
+            r["records"] = self.records
+        return r
+
+
+class LatencyStats:
+    # Opt-in: enabled when BOT_STATS names the JSON file to dump on exit
+    def __init__(self, dump_path=None):
+        self.dump_path = dump_path
+        self.enabled = bool(dump_path)
+        self.histograms = defaultdict(Histogram)
+        # set by the bot to report the current number of contacts
+        self.count_records = None
+        # per thread: seconds waited for the user inside each open measure
+        self.local = threading.local()
+        if self.enabled:
+            atexit.register(self.dump)
+
+    @contextmanager
+    def measure(self, label: str):
+        waits = self.local.__dict__.setdefault("waits", [])
+        waits.append(0.0)
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - t - waits.pop()
+            # counted after the clock stops: a database or sharded book may
+            # need a query or a round trip for it
+            records = self.count_records() if self.count_records else None
+            self.histograms[label].add(elapsed, records)
+
+    @contextmanager
+    def pause(self):
+        # time spent here (a prompt) is left out of every open measure
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            waits = self.local.__dict__.get("waits", [])
+            waits[:] = [x + perf_counter() - t for x in waits]
+
+    def timed(self, label: str):
+        return self.measure(label) if self.enabled else nullcontext()
+
+    def waiting(self):
+        return self.pause() if self.enabled else nullcontext()
+
+    def timer(self, label: str):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timed(label):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def command(self, f):
+        # parse_command decorator: one histogram per command word
+        @wraps(f)
+        def wrapper(s, *args):
+            x = s.split()
+            with self.timed(x[0].lower() if x else "<empty>"):
+                return f(s, *args)
+        return wrapper
+
+    def to_dict(self) -> dict:
+        return {k: v.to_dict() for k, v in sorted(self.histograms.items())}
+
+    def dump(self, path=None):
+        with open(path or self.dump_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def __str__(self) -> str:
+        if not self.enabled:
+            return f"Statistics are disabled (set {STATS_ENV} to a JSON file name to enable)"
+        rows = [
+            "{:<24} {:>8} {:>10} {:>10} {:>10} {:>10}".format("Command", "Count", "p50 ms", "p95 ms", "p99 ms", "max ms"),
+            "-" * 24 + " " + " ".join(["-" * 8] + ["-" * 10] * 4),
+        ]
+        for k, v in sorted(self.histograms.items()):
+            rows.append(
+                "{:<24} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                    k, v.count, *(v.percentile(p) * 1000 for p in PERCENTILES), v.max * 1000
+                )
+            )
+        return "\n".join(rows)
+
+
+stats = LatencyStats(os.environ.get(STATS_ENV))
@@ -0,0 +1,252 @@
+import io
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+from contextlib import redirect_stdout
+from time import perf_counter
+
+import bot3
+from latency import Histogram, PERCENTILES
+
+HOST = "127.0.0.1"
+PORT = 8765
+# commands that change the book; everything else is a read
+WRITE_COMMANDS = {"add", "change", "delete"}
+CLOSE_COMMANDS = {"exit", "close", "good bye"}
+# a reply is its lines followed by END; reply lines starting with '.' get
+# another '.' in front, as in SMTP
+END = "."
+CONNECTIONS = 10
+COMMANDS = 10000
+PIPELINE = 16
+SEED = 0
+
+
+def command_word(line: str) -> str:
+    # the commands key parse_command would pick for this line
+    x = line.split()
+    if not x:
+        return ""
+    if x[0].lower() in bot3.commands:
+        return x[0].lower()
+    return " ".join(x[:2]).lower()
+
+
+def execute(line: str) -> str:
+    # parse_command with everything it logs or prints captured as the reply;
+    # it never awaits, so concurrent clients can't interleave inside it
+    bot3.log = []
+    out = io.StringIO()
+    with redirect_stdout(out):
+        bot3.parse_command(line)
+    return out.getvalue() + "\n".join(bot3.log)
+
+
+def try_execute(line: str) -> tuple:
+    # (reply, True), or (error reply, False) when the command raised: bot3's
+    # input_error doesn't catch everything, and one bad command must not take
+    # down the writer task or the connection
+    try:
+        return execute(line), True
+    except Exception as e:
+        return f"Error: {type(e).__name__}: {e}", False
+
+
+def frame(reply: str) -> bytes:
+    lines = ["." + x if x.startswith(".") else x for x in reply.split("\n")]
+    return ("\n".join(lines) + "\n" + END + "\n").encode()
+
+
+class BookServer:
+    # One shared bot3 book. Reads run as soon as they arrive; mutations go
+    # through a queue to a single writer task, which applies them in order
+    # and appends them to the journal before answering.
+
+    def __init__(self, journal_path=None):
+        self.journal_path = journal_path
+        self.journal = None
+        self.queue = asyncio.Queue()
+
+    def replay(self):
+        if self.journal_path and os.path.exists(self.journal_path):
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    execute(line.strip())
+        if self.journal_path:
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+    async def writer(self):
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            results = [try_execute(line) for line, _ in batch]
+            # one flush and fsync per batch however many clients wrote; a
+            # command that failed isn't replayed
+            if self.journal:
+                try:
+                    done = (line for (line, _), (_, ok) in zip(batch, results) if ok)
+                    self.journal.writelines(line + "\n" for line in done)
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+                except OSError as e:
+                    results = [(f"Error: journal not written: {e}", False)] * len(batch)
+            for (_, future), (reply, _) in zip(batch, results):
+                future.set_result(reply)
+
+    async def handle(self, reader, writer):
+        # Commands are read as fast as the client sends them; replies are
+        # written in the same order by reply_loop. A read waits for this
+        # connection's own last write, so pipelined clients see their edits.
+        replies = asyncio.Queue()
+        reply_task = asyncio.create_task(self.reply_loop(replies, writer))
+        last_write = None
+        loop = asyncio.get_running_loop()
+        try:
+            while line := await reader.readline():
+                line = line.decode(errors="replace").strip()
+                word = command_word(line)
+                if word in WRITE_COMMANDS:
+                    last_write = loop.create_future()
+                    await self.queue.put((line, last_write))
+                    await replies.put(last_write)
+                else:
+                    if last_write is not None and not last_write.done():
+                        await last_write
+                    await replies.put(try_execute(line)[0])
+                if word in CLOSE_COMMANDS:
+                    break
+        finally:
+            await replies.put(None)
+            await reply_task
+            writer.close()
+
+    @staticmethod
+    async def reply_loop(replies, writer):
+        while (reply := await replies.get()) is not None:
+            if isinstance(reply, asyncio.Future):
+                reply = await reply
+            writer.write(frame(reply))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+
+    async def serve(self, host=HOST, port=PORT):
+        self.replay()
+        bot3.paginate = False
+        writer_task = asyncio.create_task(self.writer())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving {len(bot3.d)} contacts on {host}:{port}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer_task.cancel()
+            if self.journal:
+                self.journal.close()
+
+
+async def read_reply(reader) -> str:
+    lines = []
+    while (line := (await reader.readline()).decode().rstrip("\n")) != END:
+        lines.append(line[1:] if line.startswith("..") else line)
+    return "\n".join(lines)
+
+
+def make_commands(n: int, client: int, rnd: random.Random) -> list:
+    # A mix of adds, changes and lookups on this client's own contacts
+    commands = []
+    users = []
+    for i in range(n):
+        x = rnd.random()
+        if not users or x < 0.3:
+            users.append(f"user_{client}_{i}")
+            commands.append(f"add {users[-1]} 380{rnd.randrange(10 ** 9):09}")
+        elif x < 0.4:
+            commands.append(f"change {rnd.choice(users)} 380{rnd.randrange(10 ** 9):09}")
+        else:
+            commands.append(f"phone {rnd.choice(users)}")
+    return commands
+
+
+async def load_client(host, port, commands, pipeline, histogram):
+    # Keep up to `pipeline` commands in flight on one connection
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = asyncio.Queue()
+    window = asyncio.Semaphore(pipeline)
+
+    async def send():
+        for c in commands:
+            await window.acquire()
+            await sent.put(perf_counter())
+            writer.write((c + "\n").encode())
+            await writer.drain()
+
+    sender = asyncio.create_task(send())
+    for _ in commands:
+        await read_reply(reader)
+        histogram.add(perf_counter() - await sent.get())
+        window.release()
+    await sender
+    writer.close()
+    await writer.wait_closed()
+
+
+async def load(args) -> dict:
+    rnd = random.Random(args.seed)
+    per_client = args.commands // args.connections
+    workloads = [make_commands(per_client, i, rnd) for i in range(args.connections)]
+    histogram = Histogram()
+    t = perf_counter()
+    await asyncio.gather(
+        *(load_client(args.host, args.port, w, args.pipeline, histogram) for w in workloads)
+    )
+    seconds = perf_counter() - t
+    report = {
+        "connections": args.connections,
+        "pipeline": args.pipeline,
+        "commands": per_client * args.connections,
+        "seconds": seconds,
+        "commands_per_second": per_client * args.connections / seconds if seconds else None,
+        "latency": histogram.to_dict(),
+    }
+    print(
+        f"{report['commands']} commands over {args.connections} connection(s) in {seconds:.3f}s:"
+        f" {report['commands_per_second']:.0f} commands/s, "
+        + ", ".join(f"p{p} {histogram.percentile(p) * 1000:.3f} ms" for p in PERCENTILES),
+        file=sys.stderr,
+    )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Address book server and load-test client")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    serve = sub.add_parser("serve", help="serve the bot3 commands over TCP, one command per line")
+    serve.add_argument("--host", default=HOST)
+    serve.add_argument("--port", type=int, default=PORT)
+    serve.add_argument("--journal", help="replay mutations from this file at start and append new ones")
+    client = sub.add_parser("load", help="run a load test against a running server")
+    client.add_argument("--host", default=HOST)
+    client.add_argument("--port", type=int, default=PORT)
+    client.add_argument("--connections", type=int, default=CONNECTIONS)
+    client.add_argument("--commands", type=int, default=COMMANDS, help="total over all connections")
+    client.add_argument("--pipeline", type=int, default=PIPELINE, help="commands in flight per connection")
+    client.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        try:
+            asyncio.run(BookServer(args.journal).serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(json.dumps(asyncio.run(load(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
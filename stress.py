@@ -0,0 +1,139 @@
+import sys
+import json
+import random
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+import bench
+
+SIZE = 20000
+THREADS = 8
+OPERATIONS = 20000
+WRITE_SHARE = 0.1
+SEED = 0
+
+
+def check(book, bot4) -> list:
+    # Compare the incremental indexes and the journal with what a rebuild
+    # from the final contacts gives
+    problems = []
+    if book.order is not None and book.order != sorted(book.data):
+        problems.append("name order is out of sync")
+    if book.indexed:
+        fresh = bot4.AddressBook.__new__(bot4.AddressBook)
+        fresh.__dict__.update(
+            name_grams=bot4.defaultdict(set),
+            name_gram_count={},
+            phone_grams=bot4.defaultdict(set),
+            calendar=bot4.defaultdict(set),
+            phone_owners=bot4.defaultdict(set),
+            phone_order=None,
+            indexed=True,
+        )
+        for k, v in book.data.items():
+            fresh.index(k, v, force=True)
+        for x in ("name_grams", "name_gram_count", "phone_grams", "calendar", "phone_owners"):
+            if getattr(fresh, x) != getattr(book, x):
+                problems.append(f"{x} is out of sync")
+        if book.phone_order is not None and book.phone_order != sorted(book.phone_owners):
+            problems.append("phone order is out of sync")
+    for query, names in list(book.query_cache.values()):
+        if names != sorted(k for k, v in book.data.items() if query.matches(v)):
+            problems.append(f"cached results for {query.text!r} are stale")
+    book.close()
+    if bot4.AddressBook(book.file_path).to_dict() != book.to_dict():
+        problems.append("journal replay differs from the book")
+    return problems
+
+
+def worker(book, bot4, names, n, write_share, seed, counts):
+    rnd = random.Random(seed)
+    for _ in range(n):
+        name = rnd.choice(names)
+        x = rnd.random()
+        try:
+            if x < write_share * 0.4:
+                book.add_phone(name, bot4.Phone(f"3809{rnd.randrange(10 ** 8):08}"))
+            elif x < write_share * 0.6:
+                record = book[name]
+                if record.phone:
+                    book.del_phone(name, record.phone[0])
+            elif x < write_share * 0.8:
+                book.update_field(name, "email", bot4.Email(f"user{rnd.randrange(1000)}@example.com"))
+            elif x < write_share:
+                record = bot4.Record(bot4.Name(name + "_copy"), phone=[bot4.Phone("380500000000")])
+                book.add_record(record, print_msg=False)
+                book.delete_record(record.name.value)
+            elif x < 0.4:
+                next(book.select(bot4.PAGE_SIZE, rnd.choice(bench.QUERIES)), None)
+            elif x < 0.5:
+                # complete searches fill the query cache
+                list(book.select(bot4.PAGE_SIZE, rnd.choice(bench.QUERIES)))
+            elif x < 0.7:
+                book.render([name])
+            elif x < 0.85:
+                book.count_phones("3805" + str(rnd.randrange(10)))
+            else:
+                book.upcoming_birthdays()
+        except KeyError:
+            # the contact was deleted by another thread between the calls
+            counts["missing"] += 1
+    with counts["lock"]:
+        counts["done"] += n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hammer one AddressBook from a thread pool")
+    parser.add_argument("--size", type=int, default=SIZE)
+    parser.add_argument("--threads", type=int, default=THREADS)
+    parser.add_argument("--operations", type=int, default=OPERATIONS, help="total over all threads")
+    parser.add_argument("--write-share", type=float, default=WRITE_SHARE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--autosave", action="store_true", help="journal through the autosave thread")
+    parser.add_argument("--db", action="store_true", help="use an SQLite book")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        _, _, bot4 = bench.import_bots()
+        source = workdir / "source.json"
+        with open(source, "w", encoding="utf-8") as f:
+            json.dump(bench.make_book(args.size, random.Random(args.seed)), f)
+        if args.db:
+            book = bot4.SqliteAddressBook(workdir / "ab.db")
+            book.import_json(source)
+        else:
+            book = bot4.AddressBook(source)
+        if args.autosave:
+            book.start_autosave()
+        names = sorted(book.keys())
+        counts = {"done": 0, "missing": 0, "lock": threading.Lock()}
+        per_thread = args.operations // args.threads
+        t = perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            futures = [
+                pool.submit(worker, book, bot4, names, per_thread, args.write_share, args.seed + i, counts)
+                for i in range(args.threads)
+            ]
+            for future in futures:
+                future.result()
+        seconds = perf_counter() - t
+        problems = [] if args.db else check(book, bot4)
+        print(
+            f"{counts['done']} operations on {args.threads} thread(s) in {seconds:.3f}s"
+            f" ({counts['done'] / seconds:.0f}/s), {counts['missing']} on deleted contacts",
+            file=sys.stderr,
+        )
+        for x in problems:
+            print("FAIL: " + x, file=sys.stderr)
+        if problems:
+            sys.exit(1)
+        print("OK", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()